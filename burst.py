@@ -0,0 +1,113 @@
+import os
+import re
+import cv2
+import numpy as np
+from datetime import datetime
+
+def name_sequence(name):
+    """('IMG_', 123) for IMG_0123.JPG, (name, None) when the name has no trailing number."""
+    stem = os.path.splitext(os.path.basename(name))[0]
+    match = re.match(r'^(.*?)(\d+)$', stem)
+    if not match:
+        return stem, None
+    return match.group(1), int(match.group(2))
+
+def _timestamp(p):
+    try:
+        return datetime.fromisoformat(p['created_time'].replace('Z', '+00:00')).timestamp()
+    except (KeyError, AttributeError, TypeError, ValueError):
+        return None
+
+def group_bursts(photos, max_gap=2.0, max_step=2, max_size=10):
+    """Split photos into bursts of consecutive frames, in (created_time, name) order.
+
+    A frame continues the burst of the previous one when both file names share the prefix
+    with numbers at most max_step apart and their created_time is at most max_gap seconds
+    apart. Photos that belong to no burst come out as groups of one.
+    """
+    # Parsed, since the raw strings do not sort by time ('...00.500Z' < '...00Z')
+    def key(p):
+        ts = _timestamp(p)
+        return (ts is None, ts or 0.0, p['name'])
+    keyed = sorted(photos, key=key)
+    groups = []
+    prev = None
+    for p in keyed:
+        prefix, number = name_sequence(p['name'])
+        ts = _timestamp(p)
+        if prev is not None and len(groups[-1]) < max_size:
+            prev_prefix, prev_number, prev_ts = prev
+            if (number is not None and prev_number is not None and prefix == prev_prefix
+                    and 0 < number - prev_number <= max_step
+                    and ts is not None and prev_ts is not None and abs(ts - prev_ts) <= max_gap):
+                groups[-1].append(p)
+                prev = (prefix, number, ts)
+                continue
+        groups.append([p])
+        prev = (prefix, number, ts)
+    return groups
+
+def thumbnail(img, size=32):
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    return cv2.resize(gray, (size, size), interpolation=cv2.INTER_AREA)
+
+def dhash(thumb, size=8):
+    """64 bit difference hash: is each pixel brighter than its right neighbour."""
+    small = cv2.resize(thumb, (size + 1, size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1])
+
+def hash_distance(a, b):
+    return int(np.unpackbits(a ^ b).sum())
+
+class BurstTracker:
+    """Remembers the representative frame of the current burst in a worker.
+
+    A frame of the same burst whose dHash and 32x32 thumbnail are close enough to the
+    representative reuses its results instead of running the models.
+    """
+    def __init__(self, max_distance=6, max_diff=8.0, verify_every=10):
+        self.max_distance = max_distance
+        self.max_diff = max_diff
+        self.verify_every = verify_every
+        self.burst = None
+        self.reset(None)
+
+    def reset(self, burst):
+        self.burst = burst
+        self.photo_id = None
+        self.thumb = None
+        self.hash = None
+        self.data = None
+        self.reused = 0
+
+    def signature(self, img):
+        thumb = thumbnail(img)
+        return thumb, dhash(thumb)
+
+    def match(self, burst, signature):
+        """The representative's (photo id, data) when the frame is a near duplicate of it, else None."""
+        if burst != self.burst:
+            self.reset(burst)
+            return None
+        if self.data is None:
+            return None
+        thumb, hash_ = signature
+        if hash_distance(hash_, self.hash) > self.max_distance:
+            return None
+        if np.abs(thumb.astype(np.int16) - self.thumb.astype(np.int16)).mean() > self.max_diff:
+            return None
+        return self.photo_id, self.data
+
+    def should_verify(self):
+        self.reused += 1
+        return self.verify_every > 0 and self.reused % self.verify_every == 0
+
+    def represent(self, photo_id, signature, data):
+        self.photo_id = photo_id
+        self.thumb, self.hash = signature
+        self.data = data
+
+def same_results(a, b):
+    """Whether a reused result agrees with a full one: same face count and bib numbers."""
+    return (len(a['face_photos']) == len(b['face_photos'])
+            and {x['bib_number'] for x in a['bib_photos']} == {x['bib_number'] for x in b['bib_photos']})
@@ -1,22 +1,49 @@
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from config import config
 
 class ClientAPI:
     def __init__(self):
-        self.api_url = config['api']['api_url'].rstrip('/')
-        self.api_key = config['api']['api_key']
+        api = config['api']
+        self.api_url = api['api_url'].rstrip('/')
+        self.api_key = api['api_key']
         self.headers = {'X-API-KEY': self.api_key}
+        self.timeout = api.get('timeout', 60)
+        self.bulk_results = True
+        # One keep-alive connection pool per client instead of a new TCP/TLS handshake per request.
+        # This is the only retry layer: GET and idempotent POSTs are retried on connection errors,
+        # timeouts and 429/5xx; other POSTs only when the connection failed, nothing was sent then
+        self.session = self._session(api, frozenset(['GET', 'POST']))
+        # (an empty allowed_methods would make urllib3 retry every method)
+        self.once_session = self._session(api, frozenset(['GET']))
 
-    def _post(self, url, data):
-        response = requests.post(url, json=data, headers=self.headers)
+    def _session(self, api, allowed_methods):
+        retry = Retry(
+            total=api.get('retries', 3),
+            backoff_factor=api.get('backoff', 0.5),
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=allowed_methods
+        )
+        adapter = HTTPAdapter(pool_maxsize=api.get('pool_size', 10), max_retries=retry)
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _post(self, url, data, idempotent=True):
+        session = self.session if idempotent else self.once_session
+        response = session.post(url, json=data, timeout=self.timeout)
         response.raise_for_status()
         return response.json()
     
     def _get(self, url, params=None):
         if params:
-            response = requests.get(url, headers=self.headers, params=params)
+            response = self.session.get(url, params=params, timeout=self.timeout)
         else:
-            response = requests.get(url, headers=self.headers)
+            response = self.session.get(url, timeout=self.timeout)
         response.raise_for_status()
         return response.json()
 
@@ -33,14 +60,30 @@ class ClientAPI:
         url = f"{self.api_url}/cloud_storage/{cloud_storage_id}/"
         return self._get(url)
 
-    def list_photos(self, cloud_storage_id, fmt='compact', incomplete=False, rows=0):
+    def list_photos(self, cloud_storage_id, fmt='compact', incomplete=False, rows=0, offset=0):
         url = f"{self.api_url}/cloud_storage/{cloud_storage_id}/photos/"
         params = {'format': fmt, 'incomplete': incomplete, 'rows': rows}
+        if offset:
+            params['offset'] = offset
         return self._get(url, params)
+
+    def iter_photos(self, cloud_storage_id, page_size=5000, fmt='compact', incomplete=False, offset=0):
+        """Yields list_photos pages of page_size rows from offset until a short page."""
+        seen = set()
+        while True:
+            page = self.list_photos(cloud_storage_id, fmt, incomplete, rows=page_size, offset=offset)
+            if page and page[0]['id'] in seen:
+                raise ValueError("Photo listing API ignores offset")
+            seen.update(p['id'] for p in page)
+            yield page
+            if len(page) < page_size:
+                break
+            offset += len(page)
     
     def add_photos(self, cloud_storage_id, new_list):
+        # Not idempotent, an add that timed out may be stored already and would be duplicated
         url = f"{self.api_url}/cloud_storage/{cloud_storage_id}/photos/add/"
-        return self._post(url, new_list)
+        return self._post(url, new_list, idempotent=False)
 
     def update_photos(self, cloud_storage_id, change):
         url = f"{self.api_url}/cloud_storage/{cloud_storage_id}/photos/update/"
@@ -53,3 +96,49 @@ class ClientAPI:
     def add_photo_result(self, photo_id, data):
         url = f"{self.api_url}/photo/{photo_id}/result/"
         return self._post(url, data)
+
+    def add_photo_results(self, results):
+        """Send several photo results in one request, results is a list of (photo_id, data).
+
+        Falls back to one add_photo_result call per photo when the API has no bulk endpoint.
+        """
+        if self.bulk_results:
+            url = f"{self.api_url}/photos/results/"
+            try:
+                return self._post(url, [{'photo_id': photo_id, 'result': data} for photo_id, data in results])
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code not in (404, 405):
+                    raise
+                self.bulk_results = False
+        return [self.add_photo_result(photo_id, data) for photo_id, data in results]
+
+class ResultBuffer:
+    """Collects photo results and sends them with add_photo_results by count or by age."""
+    def __init__(self, client, max_count=20, max_wait=5.0):
+        self.client = client
+        self.max_count = max(max_count, 1)
+        self.max_wait = max_wait
+        self.items = []
+        self.first_at = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, photo_id, data):
+        if not self.items:
+            self.first_at = time.time()
+        self.items.append((photo_id, data))
+
+    def time_left(self):
+        if not self.items:
+            return None
+        return max(self.max_wait - (time.time() - self.first_at), 0)
+
+    def is_due(self):
+        return bool(self.items) and (len(self.items) >= self.max_count or self.time_left() <= 0)
+
+    def flush(self):
+        items, self.items = self.items, []
+        if items:
+            self.client.add_photo_results(items)
+        return items
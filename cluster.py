@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+
+class FaceClusters:
+    """Online identity clustering of L2-normalized face embeddings.
+
+    Leader clustering: a face joins the most similar cluster when the cosine similarity
+    to its centroid reaches threshold, otherwise it starts a new cluster. Every face is
+    seen once, so rows can be added as scan results arrive. Since the first faces of a
+    person may seed several clusters, each block ends with a merge pass over the centroids
+    it touched. Centroids are the normalized sums of the members; members are kept per
+    cluster as a CSR (order, offsets).
+    """
+    FILES = ('cluster_sums.npy', 'cluster_labels.npy', 'cluster_meta.json')
+
+    def __init__(self, dim, threshold=0.7, sums=None, labels=None):
+        self.dim = dim
+        self.threshold = threshold
+        self.sums = sums if sums is not None else np.zeros((0, dim), dtype=np.float32)
+        self.labels = labels if labels is not None else np.zeros(0, dtype=np.int64)
+        self._refresh()
+
+    def _refresh(self):
+        norms = np.linalg.norm(self.sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self.centroids = (self.sums / norms).astype(np.float32)
+        self.order = np.argsort(self.labels, kind='stable')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(self.labels, minlength=len(self.sums)))]).astype(np.int64)
+
+    def __len__(self):
+        return len(self.sums)
+
+    @property
+    def rows(self):
+        return len(self.labels)
+
+    def add(self, block):
+        """Cluster the next rows, block must continue right after the rows seen so far."""
+        block = np.asarray(block, dtype=np.float32)
+        labels = np.full(len(block), -1, dtype=np.int64)
+        if len(self.sums):
+            # Faces close to an existing centroid are assigned in one matrix multiply
+            scores = block @ self.centroids.T
+            best = scores.argmax(axis=1)
+            close = scores[np.arange(len(block)), best] >= self.threshold
+            labels[close] = best[close]
+        # The rest one by one, each may start a cluster that later faces of the block join
+        rest = np.flatnonzero(labels < 0)
+        new_sums = np.zeros((len(rest), self.dim), dtype=np.float32)
+        new_centroids = np.zeros((len(rest), self.dim), dtype=np.float32)
+        count = 0
+        for i in rest:
+            if count:
+                scores = new_centroids[:count] @ block[i]
+                j = int(scores.argmax())
+                if scores[j] >= self.threshold:
+                    labels[i] = len(self.sums) + j
+                    new_sums[j] += block[i]
+                    new_centroids[j] = new_sums[j] / np.linalg.norm(new_sums[j])
+                    continue
+            labels[i] = len(self.sums) + count
+            new_sums[count] = new_centroids[count] = block[i]
+            count += 1
+        updated = self.sums.copy()
+        old = labels < len(self.sums)
+        np.add.at(updated, labels[old], block[old])
+        self.sums = np.concatenate([updated, new_sums[:count]])
+        self.labels = np.concatenate([self.labels, labels])
+        self._refresh()
+        self._merge(np.unique(labels))
+        return self.labels[len(self.labels) - len(block):]
+
+    def _merge(self, touched, block_rows=1024):
+        """Join every touched cluster with its most similar centroid while that reaches threshold."""
+        while len(touched):
+            parent = np.arange(len(self.sums))
+            def root(c):
+                while parent[c] != c:
+                    parent[c] = parent[parent[c]]
+                    c = parent[c]
+                return c
+            merged = False
+            for start in range(0, len(touched), block_rows):
+                ids = touched[start:start + block_rows]
+                scores = self.centroids[ids] @ self.centroids.T
+                scores[np.arange(len(ids)), ids] = -np.inf
+                best = scores.argmax(axis=1)
+                close = scores[np.arange(len(ids)), best] >= self.threshold
+                for c, other in zip(ids[close], best[close]):
+                    a, b = root(c), root(other)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+                        merged = True
+            if not merged:
+                return
+            roots = np.array([root(c) for c in range(len(parent))])
+            kept, remap = np.unique(roots, return_inverse=True)
+            sums = np.zeros((len(kept), self.dim), dtype=np.float32)
+            np.add.at(sums, remap, self.sums)
+            self.sums = sums
+            self.labels = remap[self.labels]
+            self._refresh()
+            # A merged centroid moved, it may now reach another cluster
+            touched = np.unique(remap[roots != np.arange(len(roots))])
+
+    def members(self, clusters):
+        if len(clusters) == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in clusters])
+
+    def save(self, index_dir):
+        np.save(os.path.join(index_dir, 'cluster_sums.npy'), self.sums)
+        np.save(os.path.join(index_dir, 'cluster_labels.npy'), self.labels)
+        with open(os.path.join(index_dir, 'cluster_meta.json'), 'w') as f:
+            json.dump({'threshold': self.threshold, 'clusters': len(self), 'rows': self.rows}, f, indent=2)
+
+    @classmethod
+    def load(cls, index_dir, dim):
+        path = os.path.join(index_dir, 'cluster_meta.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            meta = json.load(f)
+        return cls(dim, meta['threshold'],
+                   np.load(os.path.join(index_dir, 'cluster_sums.npy')),
+                   np.load(os.path.join(index_dir, 'cluster_labels.npy')))
+
+    @classmethod
+    def remove(cls, index_dir):
+        for name in cls.FILES:
+            path = os.path.join(index_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
@@ -3,14 +3,21 @@ from gphoto import GooglePhotos
 from client_api import ClientAPI
 from utils import setup_logging
 from config import config
-from multiprocessing import set_start_method
-from scan import Scaner
+from scan import Scaner, configure_start_method, open_image
+from search import SearchIndex, benchmark, build_index, event_index_dir
+from match import match_event, read_roster
+from scan_results import ResultLog, journal_state, replay, result_files
+from incremental import CursorInvalid, CursorStore, apply_delta, drive_cursor, drive_delta
+from utils import compare_timestamps, extract_folder_id
+import os
 import json
+import time
 
 client = ClientAPI()
-gdrive = GoogleDrive()
+gdrive = GoogleDrive(list_threads=config.get('refresh', {}).get('list_threads', 8))
 gphoto = GooglePhotos()
 logger = setup_logging(config['logging']['cli_prefix'])
+cursors = CursorStore(config.get('refresh', {}).get('cursor_file', './state/refresh_cursors.json'))
 
 def remove_keys(list):
     for i in list:
@@ -30,25 +37,143 @@ def detect_url_type(url):
         return 2 # Google Photos
     raise Exception(f"Unsupported URL: {url}")
 
-def _refresh(cs_type, url, recursive, dblist):
-    gdlist = []
-    if (cs_type == 1):
+class MutationStream:
+    """Sends add/update/delete mutations in bounded chunks while the diff is still running.
+
+    Retries are left to ClientAPI, which knows which requests are safe to send again.
+    """
+    def __init__(self, label, send, cloud_storage_id, chunk_size=500, on_sent=None):
+        self.label = label
+        self.on_sent = on_sent
+        self.send = send
+        self.cloud_storage_id = cloud_storage_id
+        self.chunk_size = max(chunk_size, 1)
+        self.items = []
+        self.sent = 0
+
+    def add(self, item):
+        self.items.append(item)
+        if len(self.items) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.items:
+            return
+        chunk, self.items = self.items, []
+        print_list(chunk)
+        j = self.send(self.cloud_storage_id, chunk)
+        self.sent += len(chunk)
+        logger.info(f"{self.label}: {self.sent} files sent, return: {j}")
+        if self.on_sent:
+            self.on_sent(chunk, j)
+
+    def close(self):
+        self.flush()
+        return self.sent
+
+def _mutation_streams(cloud_storage_id, on_sent=None):
+    """on_sent(chunk, response) is called after each chunk of new or changed photos is stored."""
+    refresh_config = config.get('refresh', {})
+    chunk_size = refresh_config.get('chunk_size', 500)
+    return (
+        MutationStream("New files", lambda cs_id, chunk: client.add_photos(cs_id, remove_keys(chunk)),
+                       cloud_storage_id, chunk_size, on_sent=on_sent),
+        MutationStream("Changed files", lambda cs_id, chunk: client.update_photos(cs_id, remove_keys(chunk)),
+                       cloud_storage_id, chunk_size, on_sent=on_sent),
+        MutationStream("Missing files", lambda cs_id, chunk: client.delete_photos(cs_id, [item['id'] for item in chunk]),
+                       cloud_storage_id, chunk_size),
+    )
+
+def _cloud_pages(cs_type, url, recursive, folders=None):
+    if cs_type == 1:
         logger.info("Get photos from google drive:")
-        gdlist = gdrive.scan_folder(url, recursive)
-        logger.info(f"Total photos from cloud storage: {len(gdlist)}")
-        logger.info("Compare photos between google drive and database:")
-        return gdrive.compare(gdlist, dblist)
-    if (cs_type == 2):
+        return gdrive.scan_folder_pages(url, recursive, folders)
+    if cs_type == 2:
         logger.info("Get photos from google photo:")
-        gdlist = gphoto.scan_photos(url)
-        logger.info(f"Total photos from cloud storage: {len(gdlist)}")
-        logger.info("Compare photos between google photos and database:")
-        return gphoto.compare(gdlist, dblist)
-    else:
-        logger.info(f"Unsupported url: {url}")
-        return [], [], []
+        return gphoto.scan_photo_pages(url)
+    raise Exception(f"Unsupported url: {url}")
+
+def _db_pages(cloud_storage_id, incomplete=False, offset=0):
+    """Database photos page by page, the rest in one page when the API ignores offset."""
+    page_size = config.get('refresh', {}).get('db_page_size', 5000)
+    seen = set()
+    try:
+        for page in client.iter_photos(cloud_storage_id, page_size, incomplete=incomplete, offset=offset):
+            seen.update(p['id'] for p in page)
+            yield page
+    except ValueError as e:
+        logger.warning(f"{e}, reading all photos at once")
+        yield [p for p in client.list_photos(cloud_storage_id, incomplete=incomplete) if p['id'] not in seen]
+
+def _db_index(cloud_storage_id):
+    """gdid -> the few database fields the diff needs, read page by page."""
+    index = {}
+    for page in _db_pages(cloud_storage_id):
+        for p in page:
+            index[p['gdid']] = {k: p.get(k) for k in ('id', 'gdid', 'name', 'size', 'modified_time')}
+        logger.info(f"Photos read from database: {len(index)}")
+    return index
+
+def _is_changed(cs_type, f, other):
+    # Google Photos sizes are not reliable, only the timestamp is compared there
+    if cs_type == 1 and f['size'] != other.get('size'):
+        return True
+    return compare_timestamps(f['modified_time'], other.get('modified_time')) != 0
+
+def _refresh_incremental(cloud_storage_id, cs_type, url, recursive, streams):
+    cursor = cursors.get(cloud_storage_id)
+    if not cursor:
+        raise CursorInvalid("No change cursor stored yet")
+    if cs_type == 1:
+        upserts, removed, next_cursor = drive_delta(gdrive, cursor, extract_folder_id(url), recursive)
+        logger.info(f"Changes since last refresh: {len(upserts)} added or modified, {len(removed)} removed")
+        if not upserts and not removed:
+            return next_cursor
+        logger.info("Get photos from database:")
+        only_new, changed, missing = apply_delta(upserts, removed, list(_db_index(cloud_storage_id).values()))
+        for stream, items in zip(streams, (only_new, changed, missing)):
+            for item in items:
+                stream.add(item)
+        return next_cursor
+    # Google Photos has no change feed: the item count misses a photo replaced by another,
+    # and creationTime is when a photo was taken, not when it was added
+    raise CursorInvalid("Only Google Drive has a change feed")
 
-def refresh(cloud_storage_id):
+def _refresh_full(cloud_storage_id, cs_type, url, recursive, streams):
+    # Take the cursor before listing so changes made while we list are seen next time
+    next_cursor = None
+    token = None
+    folders = set()
+    try:
+        if cs_type == 1:
+            token = gdrive.get_start_page_token()
+    except Exception as e:
+        logger.warning(f"Can't get change cursor, next refresh will be a full refresh: {e}")
+    logger.info("Get photos from database:")
+    db = _db_index(cloud_storage_id)
+    logger.info(f"Total photos from database: {len(db)}")
+
+    # Diff every cloud page as it arrives, only the compact database index stays in memory
+    only_new, changed, missing = streams
+    seen = set()
+    for page in _cloud_pages(cs_type, url, recursive, folders):
+        for f in page:
+            seen.add(f['gdid'])
+            other = db.get(f['gdid'])
+            if other is None:
+                only_new.add(f)
+            elif _is_changed(cs_type, f, other):
+                changed.add(f)
+        logger.info(f"Photos listed from cloud storage: {len(seen)}")
+    logger.info(f"Total photos from cloud storage: {len(seen)}")
+    for gdid, other in db.items():
+        if gdid not in seen:
+            missing.add(other)
+    if cs_type == 1 and token:
+        next_cursor = drive_cursor(token, extract_folder_id(url), recursive, folders)
+    return next_cursor
+
+def refresh(cloud_storage_id, full=False):
     logger.info(f"Start refreshing: ")
     logger.info(f"Get cloud storage detail for ID {cloud_storage_id}")
     cs = client.get_cloud_storage_detail(cloud_storage_id)
@@ -58,42 +183,226 @@ def refresh(cloud_storage_id):
     logger.info(f"Event ID: {cs['event_id']}")
     logger.info(f"Cloud Storage URL: {cs['url']}")
     logger.info(f"Cloud Storage recursive: {cs['recursive']}")
-    logger.info("Get photos from database:")
-    dblist = client.list_photos(cloud_storage_id)
-    logger.info(f"Total photos from database: {len(dblist)}")
     cs_type = detect_url_type(cs['url'])
     logger.info(f"URL type: {cs_type}")
-    only_new, changed, missing = _refresh(cs_type, cs['url'], cs['recursive'], dblist)
-    logger.info(f"New file: {len(only_new)}")
-    logger.info(f"Changed file: {len(changed)}")
-    logger.info(f"Missing file: {len(missing)}")
-
-    if len(only_new) > 0:
-        logger.info(f"Processing new files")
-        print_list(only_new)
-        j = client.add_photos(cloud_storage_id, remove_keys(only_new))
-        logger.info(f"return: {j}")
-
-    if len(changed) > 0:
-        logger.info(f"Processing change files")
-        print_list(changed)
-        j = client.update_photos(cloud_storage_id, remove_keys(changed))
-        logger.info(f"return: {j}")
-
-    if len(missing) > 0:
-        logger.info(f"Processing missing files")
-        print_list(missing)
-        gdids = [item['id'] for item in missing]
-        j = client.delete_photos(cloud_storage_id, gdids)
-        logger.info(f"return: {j}")
+    streams = _mutation_streams(cloud_storage_id)
+    next_cursor = None
+    done = False
+    if not full and config.get('refresh', {}).get('incremental', True):
+        try:
+            next_cursor = _refresh_incremental(cloud_storage_id, cs_type, cs['url'], cs['recursive'], streams)
+            done = True
+        except CursorInvalid as e:
+            logger.info(f"Incremental refresh not possible ({e}), running a full refresh")
+    if not done:
+        next_cursor = _refresh_full(cloud_storage_id, cs_type, cs['url'], cs['recursive'], streams)
+    only_new, changed, missing = (stream.close() for stream in streams)
+    logger.info(f"New file: {only_new}")
+    logger.info(f"Changed file: {changed}")
+    logger.info(f"Missing file: {missing}")
+    # Only move the cursor once the database has every change up to it
+    cursors.set(cloud_storage_id, next_cursor)
     cs = client.get_cloud_storage_detail(cloud_storage_id)
     logger.info(json.dumps(cs, indent=2))
     logger.info(f"Done")
 
-def scan(cloud_storage_id):
+class RegisteredLookup:
+    """Finds the database rows of just stored gdids while an ingest keeps adding photos.
+
+    Reads the full photo listing forward from where the previous lookup stopped. That
+    listing only grows during an ingest, unlike the incomplete one that the workers
+    shrink, so offsets stay valid and every row is read about once per ingest. Only the
+    fields a chunk item lacks are kept per row.
+    """
+    FIELDS = ('id', 'gdid', 'modified_time', 'storage_type')
+
+    def __init__(self, cloud_storage_id):
+        self.cloud_storage_id = cloud_storage_id
+        self.index = {}
+
+    def _read(self, gdids, offset):
+        for page in _db_pages(self.cloud_storage_id, offset=offset):
+            for p in page:
+                self.index[p['gdid']] = {k: p[k] for k in self.FIELDS if k in p}
+            if gdids <= self.index.keys():
+                return
+
+    def find(self, gdids):
+        """gdid -> row for the gdids found in the database."""
+        gdids = set(gdids)
+        if not gdids <= self.index.keys():
+            # Every row known so far came before the new ones
+            self._read(gdids, len(self.index))
+        if not gdids <= self.index.keys():
+            # The new rows did not land at the end of the listing
+            logger.warning("Stored photos not found past the known rows, reading all photos again")
+            self._read(gdids, 0)
+            missing = gdids - self.index.keys()
+            if missing:
+                logger.warning(f"{len(missing)} stored photos not found in the database: {sorted(missing)[:10]}")
+        return {gdid: self.index[gdid] for gdid in gdids if gdid in self.index}
+
+def _registered_photos(lookup, cs_type, chunk, response):
+    """Database rows of a just stored chunk, ready for the scan queue."""
+    if isinstance(response, list) and response and all(isinstance(r, dict) and 'id' in r and 'gdid' in r for r in response):
+        photos = response
+    else:
+        # The API does not echo the stored rows, the chunk items get their database id
+        rows = lookup.find(f['gdid'] for f in chunk)
+        photos = [{**rows[f['gdid']], **f} for f in chunk if f['gdid'] in rows]
+    for p in photos:
+        p.setdefault('storage_type', cs_type)
+    return photos
+
+def sync(cloud_storage_id):
+    """Upload the journaled results the API never acknowledged, returns how many are still unsent."""
+    results_config = config.get('results', {})
+    results_dir = results_config.get('dir', './results')
+    files = result_files(results_dir, [cloud_storage_id])
+    state = journal_state(files)
+    unsent = sum(not entry['acked'] for entry in state.values())
+    logger.info(f"Result journal of cloud storage {cloud_storage_id}: {len(state)} photos, {unsent} not sent")
+    if not unsent:
+        return 0
+    journal = ResultLog(results_dir, cloud_storage_id, 'sync', results_config.get('fsync', False))
     try:
-        set_start_method('spawn')
-    except RuntimeError:
-        pass
+        sent, rejected = replay(client, files, state, journal, logger, config['api'].get('bulk_size', 20))
+    finally:
+        journal.close()
+    logger.info(f"Synced {sent} of {unsent} results, {rejected} rejected by the API")
+    return unsent - sent - rejected
+
+def _resume(cloud_storage_id):
+    # Results left unsent by an earlier scan go out first, the scan skips those that still could not be sent
+    if config.get('results', {}).get('enabled', True) and config.get('results', {}).get('resume', True):
+        sync(cloud_storage_id)
+
+def ingest(cloud_storage_id):
+    """Refresh and scan in one pass, workers start on the first listed page."""
+    logger.info(f"Start ingesting: ")
+    cs = client.get_cloud_storage_detail(cloud_storage_id)
+    if not cs:
+        logger.error(f"No cloud storage found for ID: {cloud_storage_id}")
+        exit(1)
+    cs_type = detect_url_type(cs['url'])
+    logger.info(f"Cloud Storage URL: {cs['url']}, type: {cs_type}, recursive: {cs['recursive']}")
+
+    def producer(feed):
+        # Photos registered by an earlier refresh but never scanned go first. They are all
+        # read before any is fed: workers completing them would shift the later pages.
+        for page in list(_db_pages(cloud_storage_id, incomplete=True)):
+            feed(page)
+        lookup = RegisteredLookup(cloud_storage_id)
+        streams = _mutation_streams(
+            cloud_storage_id,
+            on_sent=lambda chunk, response: feed(_registered_photos(lookup, cs_type, chunk, response))
+        )
+        next_cursor = _refresh_full(cloud_storage_id, cs_type, cs['url'], cs['recursive'], streams)
+        for stream in streams:
+            stream.close()
+        cursors.set(cloud_storage_id, next_cursor)
+        logger.info(f"Ingest listing done")
+
+    _resume(cloud_storage_id)
+    configure_start_method()
+    scaner = Scaner(cloud_storage_id)
+    scaner.ingest(producer)
+
+def scan(cloud_storage_id):
+    _resume(cloud_storage_id)
+    configure_start_method()
     scaner = Scaner(cloud_storage_id)
     scaner.scan()
+
+def _event_storages(event_id, cloud_storage_ids=None):
+    if cloud_storage_ids:
+        return cloud_storage_ids
+    detail = client.get_event_detail(event_id)
+    return [c['id'] for c in detail['cloudstorage']]
+
+def _search_index(event_id):
+    search_config = config.get('search', {})
+    return SearchIndex(event_index_dir(search_config.get('index_dir', './index'), event_id),
+                       search_config.get('block_rows', 262144))
+
+def search_build(event_id, cloud_storage_ids=None, ivf=False):
+    search_config = config.get('search', {})
+    storages = _event_storages(event_id, cloud_storage_ids)
+    logger.info(f"Build search index for event {event_id} from cloud storages {storages}")
+    start = time.time()
+    meta = build_index(event_index_dir(search_config.get('index_dir', './index'), event_id),
+                       config.get('results', {}).get('dir', './results'), storages, config['deepface']['embedding_dim'],
+                       search_config.get('cluster_threshold', 0))
+    logger.info(f"Indexed {meta['count']} faces in {meta['clusters']} clusters and {meta['bibs']} bibs "
+                f"of {meta['photos']} photos in {time.time() - start:.2f} seconds")
+    if ivf:
+        start = time.time()
+        index = _search_index(event_id)
+        index.build_ivf(search_config.get('ivf_nlist', 0), search_config.get('pq_m', 0))
+        logger.info(f"Built IVF index with {len(index.ivf.centroids)} lists in {time.time() - start:.2f} seconds")
+    print(json.dumps(meta, indent=2))
+
+def search_cluster(event_id, threshold=None):
+    search_config = config.get('search', {})
+    threshold = threshold or search_config.get('cluster_threshold', 0) or 0.7
+    index = _search_index(event_id)
+    start = time.time()
+    clusters = index.update_clusters(threshold)
+    logger.info(f"Clustered {index.count} faces into {len(clusters)} identities in {time.time() - start:.2f} seconds")
+
+def search_query(event_id, image=None, bib=None, k=None):
+    search_config = config.get('search', {})
+    k = k or search_config.get('top_k', 20)
+    index = _search_index(event_id)
+    result = {}
+    if image:
+        # Same face pipeline as the scan, so query and index embeddings match
+        from processor import ImageProcessor
+        processor = ImageProcessor(config, logger)
+        img = open_image(image, config.get('image', {}).get('max_width', 2000))
+        faces, _ = processor.process_faces(img, image, logger)
+        embeddings = [embedding for embedding, _, _ in faces]
+        if not embeddings:
+            logger.error(f"No face found in {image}")
+        else:
+            start = time.perf_counter()
+            hits = index.search(embeddings, k, search_config.get('min_score', 0.5),
+                                nprobe=search_config.get('ivf_nprobe', 8),
+                                cluster_probe=search_config.get('cluster_probe', 32))
+            logger.info(f"Face search took {(time.perf_counter() - start) * 1000:.2f} ms")
+            result['faces'] = [{'photo_id': photo_id, 'score': score, 'confidence': confidence}
+                               for photo_id, score, confidence in hits]
+    if bib:
+        result['bibs'] = [{'photo_id': photo_id, 'confidence': confidence} for photo_id, confidence in index.search_bib(bib)]
+    print(json.dumps(result, indent=2))
+
+def search_bench(event_id, queries=100, k=None):
+    search_config = config.get('search', {})
+    report = benchmark(_search_index(event_id), queries, k or search_config.get('top_k', 20),
+                       search_config.get('ivf_nprobe', 8), cluster_probe=search_config.get('cluster_probe', 32))
+    print(json.dumps(report, indent=2))
+
+def match(event_id, roster_path, output_dir=None):
+    """Match every participant of the roster against the event index, one manifest per participant."""
+    match_config = config.get('match', {})
+    output_dir = os.path.join(output_dir or match_config.get('output_dir', './matches'), f"event_{event_id}")
+    roster = read_roster(roster_path)
+    logger.info(f"Matching {len(roster)} participants of event {event_id}")
+    from processor import ImageProcessor
+    processor = ImageProcessor(config, logger)
+    match_event(_search_index(event_id), processor, roster, output_dir, match_config,
+                config.get('image', {}).get('max_width', 2000), logger)
+
+def export_models(quantize=True, ocr=True, check_dir=None):
+    """Convert the embedding and OCR models for inference.backend onnx, optionally check parity."""
+    import model_export
+    if check_dir is None:
+        model_export.export_embedding(config, logger, quantize)
+        if ocr:
+            model_export.export_ocr(config, logger)
+        return
+    report, passed = model_export.parity_check(config, logger, check_dir)
+    print(json.dumps(report, indent=2))
+    if not passed:
+        logger.error(f"ONNX embeddings differ from the Keras ones, keep inference.backend on keras")
+        exit(1)
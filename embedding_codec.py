@@ -0,0 +1,49 @@
+import base64
+import numpy as np
+
+# json:    {'embedding': [floats]}, what the API always accepted
+# float16: L2-normalized vector as little endian float16, base64 encoded
+# int8:    L2-normalized vector quantized with one symmetric scale per vector, base64 encoded
+FORMATS = ('json', 'float16', 'int8')
+
+def encode_embedding(embedding, fmt='json', dim=None):
+    vec = np.asarray(embedding, dtype=np.float32).ravel()
+    if dim is not None and len(vec) != dim:
+        raise ValueError(f"Embedding has {len(vec)} dimensions, expected {dim}")
+    if fmt == 'json':
+        return {'embedding': vec.tolist()}
+    norm = np.linalg.norm(vec)
+    if norm > 0:
+        vec = vec / norm
+    if fmt == 'float16':
+        return {
+            'embedding_b64': base64.b64encode(vec.astype('<f2').tobytes()).decode('ascii'),
+            'embedding_dtype': 'float16',
+            'embedding_dim': len(vec)
+        }
+    if fmt == 'int8':
+        scale = float(np.abs(vec).max()) / 127 or 1.0
+        quantized = np.clip(np.round(vec / scale), -127, 127).astype(np.int8)
+        return {
+            'embedding_b64': base64.b64encode(quantized.tobytes()).decode('ascii'),
+            'embedding_dtype': 'int8',
+            'embedding_dim': len(vec),
+            'embedding_scale': scale
+        }
+    raise ValueError(f"Unsupported embedding format: {fmt}")
+
+def decode_embedding(face):
+    """Return the float32 vector of a face payload in any of the FORMATS."""
+    if 'embedding' in face:
+        return np.asarray(face['embedding'], dtype=np.float32)
+    raw = base64.b64decode(face['embedding_b64'])
+    dtype = face['embedding_dtype']
+    if dtype == 'float16':
+        vec = np.frombuffer(raw, dtype='<f2').astype(np.float32)
+    elif dtype == 'int8':
+        vec = np.frombuffer(raw, dtype=np.int8).astype(np.float32) * face['embedding_scale']
+    else:
+        raise ValueError(f"Unsupported embedding dtype: {dtype}")
+    if len(vec) != face['embedding_dim']:
+        raise ValueError(f"Embedding has {len(vec)} dimensions, payload declares {face['embedding_dim']}")
+    return vec
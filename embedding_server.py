@@ -0,0 +1,115 @@
+import os
+import time
+import queue
+import traceback
+import numpy as np
+from multiprocessing import parent_process
+from utils import setup_logging
+
+class EmbeddingClient:
+    """Worker side of the embedding server, a drop-in replacement for processor.FaceEmbedder."""
+    def __init__(self, worker_id, request_queue, reply_queue, timeout=60):
+        self.worker_id = worker_id
+        self.request_queue = request_queue
+        self.reply_queue = reply_queue
+        self.timeout = timeout
+        # A worker slot keeps its reply queue across restarts, the pid keeps a restarted
+        # worker from taking replies meant for the process it replaced
+        self.pid = os.getpid()
+        self.seq = 0
+
+    def embed(self, faces):
+        if len(faces) == 0:
+            return []
+        self.seq += 1
+        request = (self.pid, self.seq)
+        self.request_queue.put((self.worker_id, request, [np.asarray(face, dtype=np.float32) for face in faces]))
+        deadline = time.time() + self.timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise TimeoutError(f"Embedding server did not answer request {request} in {self.timeout} seconds")
+            try:
+                request_id, embeddings = self.reply_queue.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            # Replies to requests we gave up on, or sent by a previous process of this slot, are dropped
+            if request_id == request:
+                if isinstance(embeddings, str):
+                    raise RuntimeError(f"Embedding server failed: {embeddings}")
+                return list(embeddings)
+
+    def warm_up(self):
+        pass
+
+def _flush(embedder, pending, reply_queues, logger, stats):
+    start = time.time()
+    faces = [face for _, _, request_faces in pending for face in request_faces]
+    try:
+        embeddings = embedder.embed(faces)
+    except Exception as e:
+        logger.error(f"Embedding batch of {len(faces)} faces failed: {str(e)}\n{traceback.format_exc()}")
+        for worker_id, request_id, _ in pending:
+            reply_queues[worker_id].put((request_id, str(e)))
+        return
+    offset = 0
+    for worker_id, request_id, request_faces in pending:
+        reply_queues[worker_id].put((request_id, np.stack(embeddings[offset:offset + len(request_faces)])))
+        offset += len(request_faces)
+    duration = time.time() - start
+    stats['batches'] += 1
+    stats['faces'] += len(faces)
+    stats['requests'] += len(pending)
+    stats['seconds'] += duration
+    logger.debug(f"Embedded batch of {len(faces)} faces from {len(pending)} requests in {duration:.3f} seconds")
+
+def embedding_server_process(request_queue, reply_queues, config, budget=None):
+    """Collects aligned faces from all scan workers and embeds them in dynamic batches.
+
+    A batch is flushed when it holds max_batch faces or when the oldest request
+    has waited max_wait_ms, whichever comes first.
+    """
+    logger = setup_logging(f"{config['logging']['scan_prefix']}_embedding")
+    server_config = config.get('embedding_server', {})
+    max_batch = server_config.get('max_batch', 64)
+    max_wait = server_config.get('max_wait_ms', 20) / 1000
+    if budget is not None:
+        from threads import apply_thread_budget
+        # The server only embeds, TensorFlow gets the whole share of the process
+        apply_thread_budget({**budget, 'tf_intra': budget['process']})
+    from processor import build_embedder
+    embedder = build_embedder(config, max_batch, budget['process'] if budget else None)
+    embedder.warm_up()
+    logger.info(f"Embedding server started, max batch {max_batch}, max wait {max_wait * 1000:.0f} ms")
+
+    stats = {'batches': 0, 'faces': 0, 'requests': 0, 'seconds': 0.0}
+    pending = []
+    pending_faces = 0
+    deadline = None
+    while True:
+        timeout = 1 if not pending else max(deadline - time.time(), 0)
+        try:
+            req = request_queue.get(timeout=timeout)
+        except queue.Empty:
+            req = False
+        if req is None:
+            break
+        if req:
+            if not pending:
+                deadline = time.time() + max_wait
+            pending.append(req)
+            pending_faces += len(req[2])
+        if pending and (pending_faces >= max_batch or time.time() >= deadline):
+            _flush(embedder, pending, reply_queues, logger, stats)
+            pending = []
+            pending_faces = 0
+        elif not pending and not parent_process().is_alive():
+            logger.info("Embedding server lost its master, exiting")
+            break
+    if pending:
+        _flush(embedder, pending, reply_queues, logger, stats)
+    if stats['batches']:
+        logger.info(f"Embedding server embedded {stats['faces']} faces from {stats['requests']} requests "
+                    f"in {stats['batches']} batches, avg batch {stats['faces'] / stats['batches']:.1f}, "
+                    f"{stats['seconds']:.2f} seconds")
+    logger.info("Embedding server exiting")
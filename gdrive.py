@@ -1,60 +1,141 @@
 import io
-from typing import List, Dict, Optional, Tuple
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterator, List, Dict, Optional, Tuple
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload
 from utils import compare_timestamps, is_image_file, extract_folder_id
 
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+PAGE_SIZE = 1000  # files().list maximum
+
 class GoogleDrive:
-    def __init__(self, service_account_path: str = "gdrive_svc_account.json", image_exts: Optional[List[str]] = None):
+    def __init__(self, service_account_path: str = "gdrive_svc_account.json", image_exts: Optional[List[str]] = None,
+                 list_threads: int = 8, service=None):
         self.service_account_path = service_account_path
+        self.list_threads = list_threads
+        self._local = threading.local()
         self.image_exts = image_exts or ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp', 'heic']
         self.image_exts = set([ext.lower() for ext in self.image_exts])
 
-        creds = service_account.Credentials.from_service_account_file(
+        if service is not None:
+            # Prebuilt (or fake) service, shared by all threads
+            self.creds = None
+            self.service = service
+            return
+        self.creds = service_account.Credentials.from_service_account_file(
             self.service_account_path,
             scopes=['https://www.googleapis.com/auth/drive.readonly']
         )
-        self.service = build('drive', 'v3', credentials=creds)
+        self.service = build('drive', 'v3', credentials=self.creds)
 
-    def _scan_folder(self, folder_id: str, recursive: bool = False) -> List[Dict]:
-        results = []
-        query = f"'{folder_id}' in parents and trashed = false"
-        page_token = None
+    def _thread_service(self):
+        # googleapiclient services are not thread safe, each listing thread builds its own
+        if self.creds is None:
+            return self.service
+        if not hasattr(self._local, 'service'):
+            self._local.service = build('drive', 'v3', credentials=self.creds)
+        return self._local.service
 
-        while True:
-            response = self.service.files().list(
-                q=query,
-                spaces='drive',
-                fields=(
-                    'nextPageToken, files(id, name, mimeType, size, createdTime, modifiedTime)'
-                ),
-                pageToken=page_token
-            ).execute()
+    def _to_photo(self, f: Dict) -> Dict:
+        return {
+            'gdid': f['id'],
+            'name': f['name'],
+            'size': int(f.get('size', 0)),
+            'created_time': f.get('createdTime'),
+            'modified_time': f.get('modifiedTime'),
+            'base_url': ''
+        }
+
+    def _list_page(self, folder_id: str, page_token: Optional[str]) -> Tuple[str, List[Dict], List[str], Optional[str]]:
+        response = self._thread_service().files().list(
+            q=f"'{folder_id}' in parents and trashed = false",
+            spaces='drive',
+            fields=(
+                'nextPageToken, files(id, name, mimeType, size, createdTime, modifiedTime)'
+            ),
+            pageSize=PAGE_SIZE,
+            pageToken=page_token
+        ).execute()
+        photos, folders = [], []
+        for f in response.get('files', []):
+            if f['mimeType'] == FOLDER_MIME_TYPE:
+                folders.append(f['id'])
+            elif is_image_file(f['name']):
+                photos.append(self._to_photo(f))
+        return folder_id, photos, folders, response.get('nextPageToken')
+
+    def iter_folder(self, folder_id: str, recursive: bool = False, folders: Optional[set] = None) -> Iterator[List[Dict]]:
+        """Yields pages of photos as soon as they are listed.
 
-            for f in response.get('files', []):
-                if f['mimeType'] == 'application/vnd.google-apps.folder' and recursive:
-                    results += self._scan_folder(f['id'], recursive=True)
-                elif is_image_file(f['name']):
-                    results.append({
-                        'gdid': f['id'],
-                        'name': f['name'],
-                        'size': int(f.get('size', 0)),
-                        'created_time': f.get('createdTime'),
-                        'modified_time': f.get('modifiedTime'),
-                        'base_url': ''
-                    })
-
-            page_token = response.get('nextPageToken')
-            if not page_token:
-                break
+        Every page of every sub folder is one task on a bounded thread pool, so sibling
+        folders and the next page of a folder are listed at the same time. The ids of
+        all listed folders are added to `folders` when given.
+        """
+        with ThreadPoolExecutor(max_workers=self.list_threads, thread_name_prefix='gdrive_list') as pool:
+            futures = {pool.submit(self._list_page, folder_id, None)}
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    parent_id, photos, sub_ids, page_token = future.result()
+                    if folders is not None:
+                        folders.add(parent_id)
+                    if page_token:
+                        futures.add(pool.submit(self._list_page, parent_id, page_token))
+                    if recursive:
+                        for sub_id in sub_ids:
+                            futures.add(pool.submit(self._list_page, sub_id, None))
+                    if photos:
+                        yield photos
+
+    def _scan_folder(self, folder_id: str, recursive: bool = False, folders: Optional[set] = None) -> List[Dict]:
+        results = []
+        for page in self.iter_folder(folder_id, recursive, folders):
+            results += page
         return results
 
-    def scan_folder(self, folder_url: str, recursive: bool = False) -> List[Dict]:
+    def scan_folder_pages(self, folder_url: str, recursive: bool = False, folders: Optional[set] = None) -> Iterator[List[Dict]]:
         folder_id = extract_folder_id(folder_url)
         if not folder_id:
             raise ValueError("Can't extract folder ID from share link")
-        return self._scan_folder(folder_id, recursive)
+        return self.iter_folder(folder_id, recursive, folders)
+
+    def scan_folder(self, folder_url: str, recursive: bool = False, folders: Optional[set] = None) -> List[Dict]:
+        folder_id = extract_folder_id(folder_url)
+        if not folder_id:
+            raise ValueError("Can't extract folder ID from share link")
+        return self._scan_folder(folder_id, recursive, folders)
+
+    def get_start_page_token(self) -> str:
+        return self.service.changes().getStartPageToken().execute()['startPageToken']
+
+    def list_changes(self, page_token: str) -> Tuple[List[Dict], str]:
+        """All changes since page_token and the token to continue from next time."""
+        changes = []
+        while True:
+            response = self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                includeRemoved=True,
+                pageSize=PAGE_SIZE,
+                fields=(
+                    'nextPageToken, newStartPageToken, changes(fileId, removed, '
+                    'file(id, name, mimeType, size, createdTime, modifiedTime, parents, trashed))'
+                )
+            ).execute()
+            for c in response.get('changes', []):
+                f = c.get('file') or {}
+                changes.append({
+                    'gdid': c['fileId'],
+                    'removed': c.get('removed', False) or f.get('trashed', False),
+                    'folder': f.get('mimeType') == FOLDER_MIME_TYPE,
+                    'parents': f.get('parents', []),
+                    'photo': self._to_photo(f) if f and is_image_file(f.get('name', '')) else None
+                })
+            if 'newStartPageToken' in response:
+                return changes, response['newStartPageToken']
+            page_token = response['nextPageToken']
 
     def download(self, gdid: str, file_path: str) -> Optional[str]:
         try:
@@ -69,6 +150,26 @@ class GoogleDrive:
             print(f"Download failed：{gdid} -> {e}")
             return None
 
+    def get_md5(self, gdid: str) -> Optional[str]:
+        try:
+            return self.service.files().get(fileId=gdid, fields='md5Checksum').execute().get('md5Checksum')
+        except Exception as e:
+            print(f"Get md5 failed：{gdid} -> {e}")
+            return None
+
+    def download_bytes(self, gdid: str) -> Optional[bytes]:
+        try:
+            request = self.service.files().get_media(fileId=gdid)
+            buf = io.BytesIO()
+            downloader = MediaIoBaseDownload(buf, request, chunksize=8 * 1024 * 1024)
+            done = False
+            while not done:
+                _, done = downloader.next_chunk()
+            return buf.getvalue()
+        except Exception as e:
+            print(f"Download failed：{gdid} -> {e}")
+            return None
+
     def compare(self, drive_file_list: List[Dict], other_file_list: List[Dict]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
         other_lookup = {f['gdid']: f for f in other_file_list}
         only_new, changed, missing = [], [], []
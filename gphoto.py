@@ -1,5 +1,5 @@
 import os
-from typing import List, Dict, Optional, Tuple
+from typing import Iterator, List, Dict, Optional, Tuple
 from google.oauth2 import credentials
 from googleapiclient.discovery import build
 import requests
@@ -20,41 +20,49 @@ class GooglePhotos:
         ret = self.service.mediaItems().get(mediaItemId=media_id).execute()
         return ret['baseUrl']
 
+    def iter_album_photos(self, album_id) -> Iterator[List[Dict]]:
+        """Yields the photos of an album one result page at a time."""
+        next_page_token = None
+        while True:
+            if next_page_token:
+                results = self.service.mediaItems().search(
+                    body={'albumId': album_id,
+                          'pageSize': 100,
+                          'pageToken': next_page_token
+                          }
+                ).execute()
+            else:
+                results = self.service.mediaItems().search(
+                    body={'albumId': album_id, 'pageSize': 100}
+                ).execute()
+            items = results.get('mediaItems', [])
+            if not items:
+                break  # No more photos in the album
+
+            photos = []
+            for item in items:
+                if not is_image_file(item.get('filename')):
+                    continue
+                photo_data = {
+                    'gdid': item.get('id'),  # Google Photos ID
+                    'name': item.get('filename'),
+                    'size': item.get('mediaMetadata.fileSize') if item.get('mediaMetadata.fileSize') else 0,
+                    'created_time': item.get('mediaMetadata', {}).get('creationTime'),
+                    'modified_time': item.get('mediaMetadata', {}).get('creationTime'),
+                    'base_url': item.get('productUrl') 
+                }
+                photos.append(photo_data)
+            if photos:
+                yield photos
+            next_page_token = results.get('nextPageToken')
+            if not next_page_token:
+                break  # No more pages
+
     def list_shared_album_photos(self, album_id):
         try:
             photos = []
-            next_page_token = None
-            while True:
-                if next_page_token:
-                    results = self.service.mediaItems().search(
-                        body={'albumId': album_id,
-                              'pageSize': 100,
-                              'pageToken': next_page_token
-                              }
-                    ).execute()
-                else:
-                    results = self.service.mediaItems().search(
-                        body={'albumId': album_id, 'pageSize': 100}
-                    ).execute()
-                items = results.get('mediaItems', [])
-                if not items:
-                    break  # No more photos in the album
-
-                for item in items:
-                    if not is_image_file(item.get('filename')):
-                        continue
-                    photo_data = {
-                        'gdid': item.get('id'),  # Google Photos ID
-                        'name': item.get('filename'),
-                        'size': item.get('mediaMetadata.fileSize') if item.get('mediaMetadata.fileSize') else 0,
-                        'created_time': item.get('mediaMetadata', {}).get('creationTime'),
-                        'modified_time': item.get('mediaMetadata', {}).get('creationTime'),
-                        'base_url': item.get('productUrl') 
-                    }
-                    photos.append(photo_data)
-                next_page_token = results.get('nextPageToken')
-                if not next_page_token:
-                    break  # No more pages
+            for page in self.iter_album_photos(album_id):
+                photos += page
             return photos
 
         except Exception as e:
@@ -73,6 +81,12 @@ class GooglePhotos:
             return []
         return self.list_shared_album_photos(album_id)
 
+    def scan_photo_pages(self, url) -> Iterator[List[Dict]]:
+        album_id = extract_album_id(url)
+        if not album_id:
+            raise ValueError(f"Can't extract album ID from url: {url}")
+        return self.iter_album_photos(album_id)
+
     def download(self, id: str, file_path: str) -> Optional[str]:
         try:
             #  Get the download URL (baseUrl)
@@ -92,6 +106,17 @@ class GooglePhotos:
             print(f"Download failed: {download_url} -> {e}")
             return None
 
+    def download_bytes(self, id: str) -> Optional[bytes]:
+        download_url = None
+        try:
+            download_url = self.get_base_url_by_id(id) + "=d"
+            response = requests.get(download_url)
+            response.raise_for_status()
+            return response.content
+        except Exception as e:
+            print(f"Download failed: {download_url or id} -> {e}")
+            return None
+
     def download_list(self, gdids: List[str], target_dir: str) -> List[str]:
         downloaded = []
         for gdid in gdids:
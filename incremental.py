@@ -0,0 +1,84 @@
+import os
+import json
+from typing import Dict, List, Optional, Tuple
+from googleapiclient.errors import HttpError
+from utils import compare_timestamps
+
+class CursorInvalid(Exception):
+    """The stored change cursor can't be used, a full diff is needed."""
+
+class CursorStore:
+    """Change cursors per cloud storage, kept in one local json file."""
+    def __init__(self, path: str):
+        self.path = path
+
+    def _load(self) -> Dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, cloud_storage_id) -> Optional[Dict]:
+        return self._load().get(str(cloud_storage_id))
+
+    def set(self, cloud_storage_id, cursor: Optional[Dict]):
+        cursors = self._load()
+        if cursor is None:
+            cursors.pop(str(cloud_storage_id), None)
+        else:
+            cursors[str(cloud_storage_id)] = cursor
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(cursors, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+def drive_cursor(token: str, folder_id: str, recursive: bool, folders) -> Dict:
+    return {'type': 'drive', 'token': token, 'folder_id': folder_id, 'recursive': recursive, 'folders': sorted(folders)}
+
+def drive_delta(gdrive, cursor: Dict, folder_id: str, recursive: bool) -> Tuple[Dict[str, Dict], set, Dict]:
+    """Photos added or modified and gdids removed under the folder since the cursor.
+
+    Returns (upserts by gdid, removed gdids, next cursor). Raises CursorInvalid when the
+    token is rejected or the folder tree changed in a way changes.list can't describe,
+    e.g. a folder full of photos moved in.
+    """
+    if cursor.get('type') != 'drive' or cursor.get('folder_id') != folder_id or cursor.get('recursive') != recursive:
+        raise CursorInvalid("Cursor was recorded for another folder")
+    folders = set(cursor['folders'])
+    try:
+        changes, token = gdrive.list_changes(cursor['token'])
+    except HttpError as e:
+        if e.resp.status in (400, 403, 404, 410):
+            raise CursorInvalid(f"Change token rejected: {e}")
+        raise
+    upserts, removed = {}, set()
+    for c in changes:
+        in_folder = any(parent in folders for parent in c['parents'])
+        # Checked by id: a permanently deleted folder comes without a file, so without a mime type
+        if c['gdid'] in folders and (c['removed'] or not in_folder):
+            raise CursorInvalid(f"Folder {c['gdid']} was removed or moved")
+        if c['folder']:
+            if recursive and not c['removed'] and in_folder and c['gdid'] not in folders:
+                raise CursorInvalid(f"Folder {c['gdid']} was added")
+        elif c['removed'] or not in_folder:
+            removed.add(c['gdid'])
+            upserts.pop(c['gdid'], None)
+        elif c['photo']:
+            upserts[c['gdid']] = c['photo']
+            removed.discard(c['gdid'])
+    return upserts, removed, drive_cursor(token, folder_id, recursive, folders)
+
+def apply_delta(upserts: Dict[str, Dict], removed: set, dblist: List[Dict]) -> Tuple[List[Dict], List[Dict], List[Dict]]:
+    """Same (only_new, changed, missing) as GoogleDrive.compare, restricted to the delta."""
+    db = {f['gdid']: f for f in dblist}
+    only_new, changed = [], []
+    for gdid, f in upserts.items():
+        other = db.get(gdid)
+        if other is None:
+            only_new.append(f)
+        elif f['size'] != other.get('size') or compare_timestamps(f['modified_time'], other.get('modified_time')) != 0:
+            changed.append(f)
+    missing = [db[gdid] for gdid in removed if gdid in db]
+    return only_new, changed, missing
@@ -0,0 +1,160 @@
+import os
+import csv
+import json
+import re
+import time
+import numpy as np
+from search import normalize
+from scan import open_image
+
+def read_roster(path):
+    """Participants from a csv with 'bib' and 'selfie' columns, other columns go into the manifests as is.
+
+    Selfie paths are relative to the roster file.
+    """
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, 'r', newline='') as f:
+        roster = list(csv.DictReader(f))
+    for row in roster:
+        row['bib'] = (row.get('bib') or '').strip()
+        selfie = (row.get('selfie') or '').strip()
+        row['selfie'] = os.path.join(base_dir, selfie) if selfie else ''
+    return roster
+
+def embed_roster(processor, roster, dim, max_width, logger, batch_size=64):
+    """One reference embedding per participant from the largest face of the selfie.
+
+    Selfies are detected one by one but embedded batch_size faces at a time, so only
+    one batch of face crops is in memory. Returns (refs, has_face).
+    """
+    refs = np.zeros((len(roster), dim), dtype=np.float32)
+    has_face = np.zeros(len(roster), dtype=bool)
+    pending, pending_rows = [], []
+
+    def flush():
+        if pending:
+            refs[pending_rows] = normalize(np.asarray(processor.embed_faces(pending)))
+            has_face[pending_rows] = True
+            pending.clear()
+            pending_rows.clear()
+
+    for i, row in enumerate(roster):
+        if not row['selfie']:
+            continue
+        try:
+            img = open_image(row['selfie'], max_width)
+        except Exception as e:
+            logger.error(f"Can't open selfie of bib {row['bib']}: {row['selfie']}: {e}")
+            continue
+        faces = processor.detect_faces(img, row['selfie'], logger)
+        if not faces:
+            logger.warning(f"No face found in selfie of bib {row['bib']}: {row['selfie']}")
+            continue
+        face, _, _ = max(faces, key=lambda f: f[2]['w'] * f[2]['h'])
+        pending.append(face)
+        pending_rows.append(i)
+        if len(pending) >= batch_size:
+            flush()
+    flush()
+    return refs, has_face
+
+def fold_hits(refs, photo_ids, scores, max_photos):
+    """Best score per (participant, photo), then the max_photos best photos of each participant."""
+    if len(refs) == 0:
+        return refs, photo_ids, scores
+    order = np.lexsort((-scores, photo_ids, refs))
+    refs, photo_ids, scores = refs[order], photo_ids[order], scores[order]
+    first = np.ones(len(refs), dtype=bool)
+    first[1:] = (refs[1:] != refs[:-1]) | (photo_ids[1:] != photo_ids[:-1])
+    refs, photo_ids, scores = refs[first], photo_ids[first], scores[first]
+    order = np.lexsort((-scores, refs))
+    refs, photo_ids, scores = refs[order], photo_ids[order], scores[order]
+    starts = np.flatnonzero(np.r_[True, refs[1:] != refs[:-1]])
+    rank = np.arange(len(refs)) - np.repeat(starts, np.diff(np.r_[starts, len(refs)]))
+    keep = rank < max_photos
+    return refs[keep], photo_ids[keep], scores[keep]
+
+def match_faces(index, refs, min_score, max_photos, block_rows=16384, ref_block=1024, compact_hits=5000000):
+    """All participants against all faces of the index with blocked matrix multiplies.
+
+    A score block is at most block_rows x ref_block float32, and the hits above min_score
+    are folded whenever they pass compact_hits, so memory stays bounded whatever the
+    event size. Returns (participant rows, photo ids, scores).
+    """
+    hit_refs, hit_photos, hit_scores = [], [], []
+    pending = 0
+    folded = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32))
+    for start in range(0, index.count, block_rows):
+        block = np.asarray(index.embeddings[start:start + block_rows])
+        block_photos = np.asarray(index.photo_ids[start:start + len(block)])
+        for ref_start in range(0, len(refs), ref_block):
+            scores = block @ refs[ref_start:ref_start + ref_block].T
+            rows, cols = np.nonzero(scores >= min_score)
+            if len(rows):
+                hit_refs.append(cols.astype(np.int64) + ref_start)
+                hit_photos.append(block_photos[rows])
+                hit_scores.append(scores[rows, cols])
+                pending += len(rows)
+        if pending > compact_hits:
+            folded = fold_hits(*(np.concatenate([a] + b) for a, b in zip(folded, (hit_refs, hit_photos, hit_scores))), max_photos)
+            hit_refs, hit_photos, hit_scores = [], [], []
+            pending = 0
+    return fold_hits(*(np.concatenate([a] + b) for a, b in zip(folded, (hit_refs, hit_photos, hit_scores))), max_photos)
+
+def write_manifests(index, roster, has_face, face_hits, output_dir, logger):
+    """One json manifest per participant with face and bib hits merged per photo, plus a summary csv."""
+    os.makedirs(output_dir, exist_ok=True)
+    hit_refs, hit_photos, hit_scores = face_hits
+    starts = np.searchsorted(hit_refs, np.arange(len(roster) + 1))
+    summary = []
+    used = set()
+    for i, row in enumerate(roster):
+        photos = {}
+        for photo_id, score in zip(hit_photos[starts[i]:starts[i + 1]], hit_scores[starts[i]:starts[i + 1]]):
+            photos[int(photo_id)] = {'photo_id': int(photo_id), 'face_score': float(score)}
+        if row['bib']:
+            for photo_id, confidence in index.search_bib(row['bib']):
+                photos.setdefault(int(photo_id), {'photo_id': int(photo_id)})['bib_confidence'] = confidence
+        for photo_id, photo in photos.items():
+            photo.update(index.photos.get(photo_id, {}))
+        # Photos matched by both face and bib first, then by face score
+        ordered = sorted(photos.values(), key=lambda p: ('face_score' in p and 'bib_confidence' in p,
+                                                         p.get('face_score', 0.0), p.get('bib_confidence', 0.0)),
+                         reverse=True)
+        manifest = {**row, 'face_found': bool(has_face[i]), 'photos': ordered}
+        # The bib comes from the roster, it must not leave output_dir; repeated bibs get the row number
+        name = re.sub(r'[^\w.-]', '_', row['bib']) if row['bib'] else f"row-{i + 1}"
+        if name in used:
+            logger.warning(f"Roster row {i + 1}: manifest {name}.json already written, using {name}-row-{i + 1}.json")
+            name = f"{name}-row-{i + 1}"
+        used.add(name)
+        with open(os.path.join(output_dir, f"{name}.json"), 'w') as f:
+            json.dump(manifest, f, indent=2)
+        summary.append({
+            'bib': row['bib'],
+            'manifest': f"{name}.json",
+            'face_found': bool(has_face[i]),
+            'face_photos': sum('face_score' in p for p in ordered),
+            'bib_photos': sum('bib_confidence' in p for p in ordered),
+            'photos': len(ordered)
+        })
+    with open(os.path.join(output_dir, 'summary.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['bib', 'manifest', 'face_found', 'face_photos', 'bib_photos', 'photos'])
+        writer.writeheader()
+        writer.writerows(summary)
+    return summary
+
+def match_event(index, processor, roster, output_dir, settings, max_width, logger):
+    start = time.time()
+    refs, has_face = embed_roster(processor, roster, index.dim, max_width, logger, settings.get('batch_size', 64))
+    embed_time = time.time()
+    logger.info(f"Embedded {int(has_face.sum())} of {len(roster)} selfies in {embed_time - start:.2f} seconds")
+    face_hits = match_faces(index, refs[has_face], settings.get('min_score', 0.6), settings.get('max_photos', 500),
+                            settings.get('block_rows', 16384), settings.get('ref_block', 1024))
+    # match_faces saw only the participants with a face, map back to roster rows
+    face_hits = (np.flatnonzero(has_face)[face_hits[0]], face_hits[1], face_hits[2])
+    match_time = time.time()
+    logger.info(f"Matched {int(has_face.sum())} participants against {index.count} faces in {match_time - embed_time:.2f} seconds")
+    summary = write_manifests(index, roster, has_face, face_hits, output_dir, logger)
+    logger.info(f"Wrote {len(summary)} manifests to {output_dir} in {time.time() - match_time:.2f} seconds")
+    return summary
@@ -0,0 +1,95 @@
+import os
+import time
+import subprocess
+import numpy as np
+from processor import FaceEmbedder, OnnxFaceEmbedder, ImageProcessor, embedding_model_path, ocr_model_path
+from scan import open_image
+from utils import is_image_file
+
+# PaddleOCR 2.x downloads its English PP-OCRv4 models here on first use
+PADDLE_MODEL_DIRS = {
+    'det': '~/.paddleocr/whl/det/en/en_PP-OCRv3_det_infer',
+    'rec': '~/.paddleocr/whl/rec/en/en_PP-OCRv4_rec_infer',
+    'cls': '~/.paddleocr/whl/cls/ch_ppocr_mobile_v2.0_cls_infer'
+}
+
+def export_embedding(config, logger, quantize=True):
+    """Convert the DeepFace Keras embedding model to ONNX, plus a dynamically int8-quantized copy."""
+    import tensorflow as tf
+    import tf2onnx
+    from deepface import DeepFace
+    inference = config.get('inference', {})
+    os.makedirs(inference.get('model_dir', './models'), exist_ok=True)
+    model = DeepFace.build_model(config['deepface']['model'])
+    height, width = model.input_shape
+    path = embedding_model_path(config, quantized=False)
+    spec = [tf.TensorSpec((None, height, width, 3), tf.float32, name='input')]
+    tf2onnx.convert.from_keras(model.model, input_signature=spec, opset=inference.get('opset', 13), output_path=path)
+    logger.info(f"Exported {config['deepface']['model']} to {path}")
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        int8_path = embedding_model_path(config, quantized=True)
+        quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+        logger.info(f"Quantized {path} to {int8_path}")
+
+def export_ocr(config, logger):
+    """Convert the PaddleOCR detection, recognition and angle models with paddle2onnx."""
+    model_dirs = {**PADDLE_MODEL_DIRS, **config.get('inference', {}).get('paddle_models', {})}
+    for part, model_dir in model_dirs.items():
+        model_dir = os.path.expanduser(model_dir)
+        if not os.path.isdir(model_dir):
+            raise FileNotFoundError(f"PaddleOCR {part} model not found in {model_dir}, run a scan once to download it")
+        path = ocr_model_path(config, part)
+        subprocess.run(['paddle2onnx', '--model_dir', model_dir,
+                        '--model_filename', 'inference.pdmodel', '--params_filename', 'inference.pdiparams',
+                        '--save_file', path, '--opset_version', '11', '--enable_onnx_checker', 'True'], check=True)
+        logger.info(f"Exported PaddleOCR {part} model to {path}")
+
+def _cosine(a, b):
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    return (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+def _timed_embed(embedder, faces):
+    embedder.warm_up()
+    start = time.perf_counter()
+    embeddings = embedder.embed(faces)
+    return embeddings, (time.perf_counter() - start) * 1000 / max(len(faces), 1)
+
+def parity_check(config, logger, image_dir, limit=200):
+    """Embed real faces with Keras and every exported ONNX model, compare them face by face.
+
+    Returns the report and whether every ONNX model stays above inference.parity_min_cosine.
+    """
+    processor = ImageProcessor(config, logger)
+    max_width = config.get('image', {}).get('max_width', 2000)
+    faces = []
+    for name in sorted(os.listdir(image_dir)):
+        if len(faces) >= limit or not is_image_file(name):
+            continue
+        path = os.path.join(image_dir, name)
+        img = open_image(path, max_width)
+        if img is not None:
+            faces += [face for face, _, _ in processor.detect_faces(img, path, logger)]
+    faces = faces[:limit]
+    if not faces:
+        raise ValueError(f"No face found in {image_dir}")
+    max_batch = config['deepface'].get('max_batch', 64)
+    reference, keras_ms = _timed_embed(FaceEmbedder(config['deepface']['model'], max_batch), faces)
+    report = {'faces': len(faces), 'keras_ms_per_face': keras_ms}
+    min_cosine = config.get('inference', {}).get('parity_min_cosine', 0.99)
+    passed = True
+    for quantized in (False, True):
+        path = embedding_model_path(config, quantized)
+        if not os.path.exists(path):
+            continue
+        embeddings, onnx_ms = _timed_embed(OnnxFaceEmbedder(path, max_batch), faces)
+        cosine = _cosine(reference, embeddings)
+        report[os.path.basename(path)] = {
+            'ms_per_face': onnx_ms,
+            'min_cosine': float(cosine.min()),
+            'mean_cosine': float(cosine.mean()),
+            'passed': bool(cosine.min() >= min_cosine)
+        }
+        passed = passed and bool(cosine.min() >= min_cosine)
+    return report, passed
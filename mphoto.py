@@ -1,7 +1,7 @@
 import argparse
 import json
 from client_api import ClientAPI
-from core import refresh, scan
+from core import export_models, ingest, match, refresh, scan, sync, search_build, search_cluster, search_query, search_bench
 
 client = ClientAPI()
 
@@ -30,11 +30,44 @@ def main():
     # refresh
     parser_refresh = subparsers.add_parser("refresh", help="Refresh cloud storage metadata")
     parser_refresh.add_argument("-c", "--cloud_storage_id", required=True, type=int, help="Cloud Storage ID")
+    parser_refresh.add_argument("-f", "--full", required=False, action='store_true', help="Ignore the change cursor and diff the whole storage")
 
     # scan
     parser_scan = subparsers.add_parser("scan", help="Scan cloud storage for new images")
     parser_scan.add_argument("-c", "--cloud_storage_id", required=True, type=int, help="Cloud Storage ID")
 
+    # ingest
+    parser_ingest = subparsers.add_parser("ingest", help="Refresh and scan in one pass, scanning starts with the first listed photos")
+    parser_ingest.add_argument("-c", "--cloud_storage_id", required=True, type=int, help="Cloud Storage ID")
+
+    # sync
+    parser_sync = subparsers.add_parser("sync", help="Upload photo results left in the local result journal")
+    parser_sync.add_argument("-c", "--cloud_storage_id", required=True, type=int, help="Cloud Storage ID")
+
+    # search
+    parser_search = subparsers.add_parser("search", help="Local face/bib search over scan results")
+    parser_search.add_argument("action", choices=["build", "cluster", "query", "bench"], help="Build the event index, cluster its faces, query it or benchmark it")
+    parser_search.add_argument("-e", "--event_id", required=True, type=int, help="Event ID")
+    parser_search.add_argument("-c", "--cloud_storage_id", required=False, type=int, action='append', help="Cloud Storage ID, repeatable (default: all of the event)")
+    parser_search.add_argument("--ivf", required=False, action='store_true', help="Also build the approximate IVF/PQ index")
+    parser_search.add_argument("-i", "--image", required=False, help="Selfie to search for")
+    parser_search.add_argument("-b", "--bib", required=False, help="Bib number to search for")
+    parser_search.add_argument("-k", "--top_k", required=False, type=int, help="Number of photos to return")
+    parser_search.add_argument("-t", "--threshold", required=False, type=float, help="Cluster similarity threshold (default: search.cluster_threshold)")
+    parser_search.add_argument("-q", "--queries", required=False, default=100, type=int, help="Benchmark query count")
+
+    # match
+    parser_match = subparsers.add_parser("match", help="Match a roster of participants against an event index")
+    parser_match.add_argument("-e", "--event_id", required=True, type=int, help="Event ID")
+    parser_match.add_argument("-r", "--roster", required=True, help="Roster csv with bib and selfie columns")
+    parser_match.add_argument("-o", "--output_dir", required=False, help="Manifest directory (default: match.output_dir)")
+
+    # export-models
+    parser_export = subparsers.add_parser("export-models", help="Convert the face and OCR models to ONNX for inference.backend onnx")
+    parser_export.add_argument("--no-quantize", required=False, action='store_true', help="Skip the int8 quantized embedding model")
+    parser_export.add_argument("--no-ocr", required=False, action='store_true', help="Skip the PaddleOCR models")
+    parser_export.add_argument("--check", required=False, help="Compare ONNX and Keras embeddings on the faces of the photos in this folder")
+
     args = parser.parse_args()
 
     # Dispatch commands
@@ -47,9 +80,28 @@ def main():
     elif args.command == "list-photos":
         print(json.dumps(client.list_photos(args.cloud_storage_id, incomplete=args.incomplete, rows=args.rows), indent=2))
     elif args.command == "refresh":
-        refresh(args.cloud_storage_id)
+        refresh(args.cloud_storage_id, full=args.full)
     elif args.command == "scan":
         scan(args.cloud_storage_id)
+    elif args.command == "ingest":
+        ingest(args.cloud_storage_id)
+    elif args.command == "sync":
+        # Non-zero while results are still unsent, so a cron job or script can retry
+        if sync(args.cloud_storage_id):
+            exit(1)
+    elif args.command == "search":
+        if args.action == "build":
+            search_build(args.event_id, args.cloud_storage_id, args.ivf)
+        elif args.action == "cluster":
+            search_cluster(args.event_id, args.threshold)
+        elif args.action == "query":
+            search_query(args.event_id, args.image, args.bib, args.top_k)
+        else:
+            search_bench(args.event_id, args.queries, args.top_k)
+    elif args.command == "match":
+        match(args.event_id, args.roster, args.output_dir)
+    elif args.command == "export-models":
+        export_models(not args.no_quantize, not args.no_ocr, args.check)
 
 if __name__ == "__main__":
     main()
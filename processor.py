@@ -1,7 +1,10 @@
 from deepface import DeepFace
+from deepface.modules import preprocessing
 from paddleocr import PaddleOCR
 import cv2
 import os
+import time
+import threading
 import numpy as np
 import tensorflow as tf
 import paddle
@@ -9,12 +12,223 @@ from datetime import datetime
 import traceback
 from utils import replace_parent_path
 
+class FaceEmbedder:
+    """人脸特征提取，一次前向计算处理一批人脸"""
+    def __init__(self, model_name, max_batch=64):
+        self.model = DeepFace.build_model(model_name)
+        self.input_shape = self.model.input_shape
+        self.max_batch = max_batch
+
+    def prepare(self, face):
+        # 与 DeepFace.represent 相同的预处理: RGB -> BGR, 缩放补边到模型输入尺寸
+        img = face[:, :, ::-1]
+        img = preprocessing.resize_image(img=img, target_size=(self.input_shape[1], self.input_shape[0]))
+        return preprocessing.normalize_input(img=img, normalization='base')
+
+    def embed(self, faces):
+        if len(faces) == 0:
+            return []
+        batch = np.concatenate([self.prepare(face) for face in faces])
+        embeddings = []
+        for i in range(0, len(batch), self.max_batch):
+            embeddings.extend(self._forward(batch[i:i + self.max_batch]))
+        return embeddings
+
+    def _forward(self, batch):
+        return self.model.model(batch, training=False).numpy()
+
+    def warm_up(self):
+        self.embed([np.zeros((self.input_shape[0], self.input_shape[1], 3), dtype=np.float32)])
+
+class OnnxFaceEmbedder(FaceEmbedder):
+    """ONNX Runtime 版本的人脸特征提取 (可以是 int8 量化模型)，预处理与 FaceEmbedder 完全相同"""
+    def __init__(self, model_path, max_batch=64, threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        self.input_shape = tuple(model_input.shape[1:3])
+        self.max_batch = max_batch
+
+    def _forward(self, batch):
+        return self.session.run(None, {self.input_name: batch.astype(np.float32)})[0]
+
+def embedding_model_path(config, quantized=None):
+    """导出的 ONNX 人脸特征模型路径，例如 models/facenet512.onnx 或 models/facenet512.int8.onnx"""
+    inference = config.get('inference', {})
+    if quantized is None:
+        quantized = inference.get('quantized', False)
+    name = config['deepface']['model'].lower() + ('.int8' if quantized else '') + '.onnx'
+    return os.path.join(inference.get('model_dir', './models'), name)
+
+def ocr_model_path(config, part):
+    """导出的 PP-OCR ONNX 模型路径，part 为 det, rec 或 cls"""
+    return os.path.join(config.get('inference', {}).get('model_dir', './models'), f"ppocr_{part}.onnx")
+
+def build_embedder(config, max_batch=64, threads=None):
+    """按 inference.backend 创建人脸特征提取器: keras (DeepFace) 或 onnx"""
+    if config.get('inference', {}).get('backend', 'keras') == 'onnx':
+        return OnnxFaceEmbedder(embedding_model_path(config), max_batch, threads)
+    return FaceEmbedder(config['deepface']['model'], max_batch)
+
+class FaceCascade:
+    """快速人脸候选检测 (Haar 或 YuNet)，在缩小的图上运行，只把有候选人脸的区域交给 MTCNN"""
+    def __init__(self, cascade_config, logger):
+        self.width = cascade_config.get('width', 640)
+        self.margin = cascade_config.get('margin', 0.5)
+        self.max_area = cascade_config.get('max_area', 0.5)
+        self.min_size = cascade_config.get('min_size', 12)
+        self.min_neighbors = cascade_config.get('min_neighbors', 3)
+        self.yunet = None
+        if cascade_config.get('backend', 'haar') == 'yunet':
+            model = cascade_config.get('yunet_model')
+            if model and os.path.exists(model):
+                self.yunet = cv2.FaceDetectorYN.create(model, "", (320, 320), cascade_config.get('score', 0.6))
+            else:
+                logger.warning(f"YuNet model not found: {model}, using the Haar cascade")
+        if self.yunet is None:
+            self.haar = cv2.CascadeClassifier(os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml'))
+
+    def candidates(self, image):
+        """原图坐标下的候选人脸框 (x, y, w, h)"""
+        h, w = image.shape[:2]
+        scale = min(1.0, self.width / w)
+        small = cv2.resize(image, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA) if scale < 1 else image
+        if self.yunet is not None:
+            self.yunet.setInputSize((small.shape[1], small.shape[0]))
+            _, faces = self.yunet.detect(small)
+            boxes = [] if faces is None else [face[:4] for face in faces]
+        else:
+            gray = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+            boxes = self.haar.detectMultiScale(gray, scaleFactor=1.1, minNeighbors=self.min_neighbors,
+                                               minSize=(self.min_size, self.min_size))
+        return [tuple(int(round(v / scale)) for v in box) for box in boxes]
+
+    def regions(self, image, boxes):
+        """候选框按 margin 向外扩展，合并重叠的区域，返回 [x0, y0, x1, y1]"""
+        h, w = image.shape[:2]
+        regions = []
+        for x, y, bw, bh in boxes:
+            mx, my = int(bw * self.margin), int(bh * self.margin)
+            regions.append([max(x - mx, 0), max(y - my, 0), min(x + bw + mx, w), min(y + bh + my, h)])
+        return merge_regions(regions)
+
+def merge_regions(regions):
+    """合并重叠的 [x0, y0, x1, y1] 区域，直到没有重叠"""
+    regions = [list(r) for r in regions]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(regions)):
+            for j in range(i + 1, len(regions)):
+                a, b = regions[i], regions[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    regions[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del regions[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return regions
+
+def offset_area(facial_area, x0, y0):
+    """把裁剪图上的 facial_area 换算回原图坐标"""
+    area = dict(facial_area)
+    area['x'] += x0
+    area['y'] += y0
+    for key in ('left_eye', 'right_eye'):
+        if area.get(key) is not None:
+            area[key] = (area[key][0] + x0, area[key][1] + y0)
+    return area
+
+def scale_area(facial_area, scale):
+    """把检测图上的 facial_area 换算到 scale 倍大小的原图"""
+    area = dict(facial_area)
+    for key in ('x', 'y', 'w', 'h'):
+        area[key] = int(round(area[key] * scale))
+    for key in ('left_eye', 'right_eye'):
+        if area.get(key) is not None:
+            area[key] = (area[key][0] * scale, area[key][1] * scale)
+    return area
+
+def crop_face(source, area):
+    """从原图裁剪人脸，有双眼坐标时与 DeepFace 一样按双眼连线转正，返回 RGB float32 (0-1)"""
+    x, y, w, h = area['x'], area['y'], area['w'], area['h']
+    if w < 2 or h < 2:
+        return None
+    cx, cy = x + w / 2, y + h / 2
+    left_eye, right_eye = area.get('left_eye'), area.get('right_eye')
+    if left_eye is not None and right_eye is not None:
+        # 先裁一块足够旋转的区域，再绕人脸中心旋转
+        half = int(max(w, h) * 0.75) + 1
+        x0, y0 = max(int(cx) - half, 0), max(int(cy) - half, 0)
+        patch = source[y0:int(cy) + half, x0:int(cx) + half]
+        angle = float(np.degrees(np.arctan2(left_eye[1] - right_eye[1], left_eye[0] - right_eye[0])))
+        matrix = cv2.getRotationMatrix2D((cx - x0, cy - y0), angle, 1.0)
+        patch = cv2.warpAffine(patch, matrix, (patch.shape[1], patch.shape[0]), flags=cv2.INTER_LINEAR)
+        face = cv2.getRectSubPix(patch, (w, h), (cx - x0, cy - y0))
+    else:
+        face = source[max(y, 0):y + h, max(x, 0):x + w]
+    if face.size == 0:
+        return None
+    return face[:, :, ::-1].astype(np.float32) / 255
+
+def sharpness(face):
+    """清晰度: 112x112 灰度人脸的拉普拉斯方差，越小越模糊"""
+    gray = cv2.cvtColor((np.clip(face, 0, 1) * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
+    gray = cv2.resize(gray, (112, 112), interpolation=cv2.INTER_AREA)
+    return float(cv2.Laplacian(gray, cv2.CV_64F).var())
+
+def eye_pose(facial_area):
+    """由双眼位置粗略估计姿态，返回 (双眼距离/脸宽, 双眼中点偏离人脸中心/脸宽)，没有双眼坐标时返回 None"""
+    left_eye, right_eye = facial_area.get('left_eye'), facial_area.get('right_eye')
+    if left_eye is None or right_eye is None or not facial_area['w']:
+        return None
+    w = facial_area['w']
+    eye_ratio = float(np.hypot(left_eye[0] - right_eye[0], left_eye[1] - right_eye[1])) / w
+    yaw = abs((left_eye[0] + right_eye[0]) / 2 - (facial_area['x'] + w / 2)) / w
+    return eye_ratio, yaw
+
 class ImageProcessor:
-    def __init__(self, config, logger):
+    def __init__(self, config, logger, embedder=None, cpu_threads=None, embed_threads=None):
         self.config = config
         self.logger = logger
+        # PaddleOCR / ONNX Runtime 推理线程数，None 时使用库的默认值
+        self.cpu_threads = cpu_threads
+        self.embed_threads = embed_threads
+        # embedder 可以是本地 FaceEmbedder，也可以是 embedding_server.EmbeddingClient
+        self.embedder = embedder
+        # 各阶段耗时 (毫秒) 和计数，由 worker 定期取走汇报给 master
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.cascade = None
+        cascade_config = config.get('cascade', {})
+        if cascade_config.get('enabled', False):
+            self.cascade = FaceCascade(cascade_config, logger)
+        # 最近一张照片被质量检查去掉的人脸数
+        self.last_face_drops = {}
         self._initialize_models()
 
+    def _add_stat(self, name, value):
+        # 人脸和 OCR 可能在两个线程里同时运行
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def pop_stats(self):
+        with self.stats_lock:
+            stats, self.stats = self.stats, {}
+        return stats
+
+    def _get_embedder(self):
+        if self.embedder is None:
+            self.embedder = build_embedder(self.config, self.config['deepface'].get('max_batch', 64), self.embed_threads)
+        return self.embedder
+
     def _initialize_models(self):
         try:
             gpus = tf.config.list_physical_devices('GPU')
@@ -33,60 +247,249 @@ class ImageProcessor:
             else:
                 self.logger.info("Running PaddleOCR on CPU as per config")
 
+            ocr_options = {}
+            if self.cpu_threads:
+                ocr_options['cpu_threads'] = self.cpu_threads
+            if self.config.get('inference', {}).get('ocr_onnx', False):
+                # mphoto.py export-models 导出的 ONNX 模型，由 ONNX Runtime 推理
+                ocr_options.update(use_onnx=True,
+                                   det_model_dir=ocr_model_path(self.config, 'det'),
+                                   rec_model_dir=ocr_model_path(self.config, 'rec'),
+                                   cls_model_dir=ocr_model_path(self.config, 'cls'))
             self.ocr = PaddleOCR(
                 use_gpu=self.config['ocr']['use_gpu'],
                 use_angle_cls=True,
                 lang='en',
-                ocr_version='PP-OCRv4'
+                ocr_version='PP-OCRv4',
+                **ocr_options
             )
             self.logger.info("PaddleOCR initialized with use_angle_cls=True")
         except Exception as e:
             self.logger.error(f"Model initialization failed: {str(e)}\n{traceback.format_exc()}")
             raise
 
-    def process_faces(self, image, image_path, logger):
-        try:
-            start_time = datetime.now()
-            logger.info(f"Starting face processing for {image_path} at {start_time}")
-
-            representations = DeepFace.represent(
-                img_path=image,
-                model_name=self.config['deepface']['model'],
-                detector_backend=self.config['deepface']['detector'],
-                align=self.config['deepface']['alignment'],
-                enforce_detection=False,  # 避免检测失败中断
-                expand_percentage=self.config['deepface']['expand_percentage']
-            )
+    def warm_up(self):
+        """用空白图片跑一遍模型，把 Facenet/MTCNN 权重和 Paddle predictor 提前加载好"""
+        start_time = datetime.now()
+        blank = np.zeros((160, 160, 3), dtype=np.uint8)
+        DeepFace.extract_faces(
+            img_path=blank,
+            detector_backend=self.config['deepface']['detector'],
+            align=self.config['deepface']['alignment'],
+            enforce_detection=False
+        )
+        self._get_embedder().warm_up()
+        self.ocr.ocr(blank)
+        duration = (datetime.now() - start_time).total_seconds()
+        self.logger.info(f"Models warmed up in {duration:.3f} seconds")
+
+    def detect_faces(self, image, image_path, logger):
+        """检测并对齐人脸，返回置信度达标的人脸 (RGB float32 人脸图, 置信度, facial_area)
+
+        开启 cascade 时先用快速检测器找候选，没有候选直接跳过 MTCNN，有候选只在候选区域上运行 MTCNN
+        """
+        if self.cascade is None:
+            return self._detect(image, image_path, logger)
+        start = time.perf_counter()
+        boxes = self.cascade.candidates(image)
+        self._add_stat('cascade_ms', (time.perf_counter() - start) * 1000)
+        if not boxes:
+            self._add_stat('cascade_skipped', 1)
+            logger.debug(f"No face candidate in {image_path}, MTCNN skipped")
+            return []
+        self._add_stat('cascade_passed', 1)
+        regions = self.cascade.regions(image, boxes)
+        h, w = image.shape[:2]
+        if sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in regions) > self.cascade.max_area * h * w:
+            # 候选区域已经覆盖了大半张图，直接整图检测
+            return self._detect(image, image_path, logger)
+        faces = []
+        for x0, y0, x1, y1 in regions:
+            for face, confidence, facial_area in self._detect(image[y0:y1, x0:x1], image_path, logger):
+                faces.append((face, confidence, offset_area(facial_area, x0, y0)))
+        return faces
+
+    def _detect(self, image, image_path, logger):
+        start = time.perf_counter()
+        face_objs = DeepFace.extract_faces(
+            img_path=image,
+            detector_backend=self.config['deepface']['detector'],
+            align=self.config['deepface']['alignment'],
+            enforce_detection=False,  # 避免检测失败中断
+            expand_percentage=self.config['deepface']['expand_percentage']
+        )
+        faces = []
+        for obj in face_objs:
+            confidence = obj.get('confidence', 0.0)
+            if confidence >= self.config['deepface']['detect_confidence']:
+                faces.append((obj['face'].astype(np.float32), confidence, obj['facial_area']))
+        self._add_stat('detect_ms', (time.perf_counter() - start) * 1000)
+        logger.debug(f"Detected {len(face_objs)} faces for {image_path}, {len(faces)} above confidence")
+        return faces
 
-            end_time = datetime.now()
-            duration = (end_time - start_time).total_seconds()
-            logger.info(f"Face processing completed for {image_path} at {end_time}, "
-                       f"found {len(representations)} faces, took {duration:.3f} seconds")
-
-            embeddings = []
-            for face_idx, rep in enumerate(representations):
-                confidence = rep.get('face_confidence', 0.0)
-                if confidence >= self.config['deepface']['detect_confidence']:
-                    embedding = np.array(rep["embedding"])
-                    embeddings.append((embedding, confidence))
-                    
-                    if self.config['deepface']['debug']:
-                        facial_area = rep['facial_area']
-                        self._draw_face(image, facial_area, confidence)
-                        draw_end_time = datetime.now()
-                        logger.debug(f"Drawing face {face_idx} completed for {image_path} at {draw_end_time}")
-
-            if self.config['deepface']['debug'] and representations:
-                self._save_debug_image(image_path, image, 'face')
-
-            return embeddings
+    def embed_faces(self, faces):
+        """批量提取 detect_faces 返回的人脸图的特征向量"""
+        return self._get_embedder().embed(faces)
+
+    def quality_gate(self, image, faces):
+        """提取特征前去掉太小、模糊、侧脸过大的人脸，最后每张照片只保留最大的 max_faces 张人脸
+
+        faces 和 image 要与提取特征时的分辨率一致，否则尺寸和清晰度阈值量的不是同一张人脸
+        返回 (保留的人脸, 各原因去掉的数量)
+        """
+        quality = self.config.get('quality', {})
+        drops = {'small': 0, 'pose': 0, 'blur': 0, 'top_k': 0}
+        if not quality.get('enabled', False):
+            return faces, drops
+        frame_width = image.shape[1]
+        kept = []
+        for face, confidence, facial_area in faces:
+            w = facial_area['w']
+            if w < quality.get('min_face_px', 24) or w < quality.get('min_face_ratio', 0.015) * frame_width:
+                drops['small'] += 1
+                continue
+            pose = eye_pose(facial_area)
+            if pose is not None and (pose[0] < quality.get('min_eye_ratio', 0.18) or pose[1] > quality.get('max_yaw', 0.25)):
+                drops['pose'] += 1
+                continue
+            if sharpness(face) < quality.get('min_sharpness', 20):
+                drops['blur'] += 1
+                continue
+            kept.append((face, confidence, facial_area))
+        max_faces = quality.get('max_faces', 0)
+        if max_faces and len(kept) > max_faces:
+            kept.sort(key=lambda f: f[2]['w'] * f[2]['h'], reverse=True)
+            drops['top_k'] = len(kept) - max_faces
+            kept = kept[:max_faces]
+        return kept, drops
+
+    def process_faces(self, image, image_path, logger, source=None):
+        """返回 ([(特征向量, 置信度, facial_area)], face_areas)
+
+        face_areas 是质量过滤前检测到的所有人脸，交给 process_bibs 定位号码布：
+        太小、模糊、侧脸的人脸不提取特征，但号码布区域不能丢
+        给出 source (同一张照片的高分辨率版本) 时，在 image 上检测人脸，从 source 裁剪人脸提取特征，
+        返回的 facial_area 也是 source 上的坐标
+
+        检测出错时当作没有人脸；提取特征出错 (包括 embedding server 超时或失败) 直接抛出，
+        这张照片算处理失败并重试，不能当作 0 张人脸上传和缓存
+        """
+        start_time = datetime.now()
+        logger.info(f"Starting face processing for {image_path} at {start_time}")
+        try:
+            faces = self.detect_faces(image, image_path, logger)
+            scale = None
+            if source is not None and source.shape[1] != image.shape[1]:
+                scale = source.shape[1] / image.shape[1]
+                # 质量过滤和提取特征用同一张从原图裁剪的人脸：缩小的检测图上又小又糊的人脸，在原图上可能合格
+                scaled = []
+                for face, confidence, facial_area in faces:
+                    facial_area = scale_area(facial_area, scale)
+                    crop = crop_face(source, facial_area)
+                    scaled.append((face if crop is None else crop, confidence, facial_area))
+                faces = scaled
+            face_areas = [facial_area for _, _, facial_area in faces]
+            detected = len(faces)
+            faces, drops = self.quality_gate(source if scale else image, faces)
+            self.last_face_drops = drops
+            for reason, count in drops.items():
+                if count:
+                    self._add_stat(f"faces_dropped_{reason}", count)
+            if len(faces) < detected:
+                logger.info(f"Quality gate kept {len(faces)} of {detected} faces for {image_path}: {drops}")
+            areas = [facial_area for _, _, facial_area in faces]
+            crops = [face for face, _, _ in faces]
         except Exception as e:
             logger.error(f"Face processing error for {image_path}: {str(e)}\n{traceback.format_exc()}")
+            return [], []
+
+        detect_time = datetime.now()
+        vectors = self._get_embedder().embed(crops)
+        self._add_stat('embed_ms', (datetime.now() - detect_time).total_seconds() * 1000)
+
+        end_time = datetime.now()
+        duration = (end_time - start_time).total_seconds()
+        logger.info(f"Face processing completed for {image_path} at {end_time}, "
+                   f"found {len(faces)} faces, took {duration:.3f} seconds "
+                   f"(detect {(detect_time - start_time).total_seconds():.3f}s)")
+
+        embeddings = []
+        for face_idx, ((_, confidence, facial_area), embedding) in enumerate(zip(faces, vectors)):
+            embeddings.append((np.asarray(embedding), confidence, areas[face_idx]))
+
+            if self.config['deepface']['debug']:
+                self._draw_face(image, scale_area(facial_area, 1 / scale) if scale else facial_area, confidence)
+                draw_end_time = datetime.now()
+                logger.debug(f"Drawing face {face_idx} completed for {image_path} at {draw_end_time}")
+
+        if self.config['deepface']['debug'] and faces:
+            self._save_debug_image(image_path, image, 'face')
+
+        return embeddings, face_areas
+
+    def bib_regions(self, image, face_areas):
+        """每张人脸下方的躯干区域，号码布一般在胸前或腹部"""
+        h, w = image.shape[:2]
+        torso = self.config['ocr'].get('torso', [1.5, 0.8, 6.0])  # 左右各扩几个脸宽, 上下边界 (脸高的倍数)
+        regions = []
+        for area in face_areas:
+            x, y, fw, fh = area['x'], area['y'], area['w'], area['h']
+            regions.append([max(int(x - torso[0] * fw), 0), max(int(y + torso[1] * fh), 0),
+                            min(int(x + fw + torso[0] * fw), w), min(int(y + torso[2] * fh), h)])
+        return [r for r in merge_regions(regions) if r[2] > r[0] and r[3] > r[1]]
+
+    def _text_boxes(self, image, regions, scale=1.0):
+        """只做文字检测 (不识别)，返回原图坐标下的文字框 [x0, y0, x1, y1]"""
+        boxes = []
+        for x0, y0, x1, y1 in regions:
+            crop = image[y0:y1, x0:x1]
+            if scale < 1:
+                crop = cv2.resize(crop, (max(int(crop.shape[1] * scale), 1), max(int(crop.shape[0] * scale), 1)),
+                                  interpolation=cv2.INTER_AREA)
+            result = self.ocr.ocr(crop, rec=False, cls=False)
+            for points in (result[0] if result and result[0] else []):
+                xs = [p[0] / scale for p in points]
+                ys = [p[1] / scale for p in points]
+                boxes.append([x0 + int(min(xs)), y0 + int(min(ys)), x0 + int(np.ceil(max(xs))), y0 + int(np.ceil(max(ys)))])
+        return boxes
+
+    def _recognize(self, image, boxes):
+        """文字框一次性批量识别，返回与 ocr.ocr 相同格式的 [[points, (text, confidence)]]"""
+        h, w = image.shape[:2]
+        crops, lines = [], []
+        for x0, y0, x1, y1 in boxes:
+            pad = max(int((y1 - y0) * 0.1), 2)
+            x0, y0, x1, y1 = max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, w), min(y1 + pad, h)
+            if x1 - x0 < 4 or y1 - y0 < 4:
+                continue
+            crops.append(image[y0:y1, x0:x1])
+            lines.append([[x0, y0], [x1, y0], [x1, y1], [x0, y1]])
+        if not crops:
             return []
+        # det=False 时传入图片列表，PaddleOCR 会把所有裁剪图放进一次识别批处理
+        result = self.ocr.ocr(crops, det=False, cls=False)
+        return [[points, tuple(rec)] for points, rec in zip(lines, result[0] if result else [])]
 
-    def process_bibs(self, image, image_path, logger):
+    def _ocr_regions(self, image, face_areas):
+        if face_areas:
+            boxes = self._text_boxes(image, self.bib_regions(image, face_areas))
+        else:
+            # 没有人脸的照片: 在缩小的整图上只做文字检测，再从原图裁剪识别
+            h, w = image.shape[:2]
+            scale = min(1.0, self.config['ocr'].get('fallback_width', 960) / w)
+            boxes = self._text_boxes(image, [[0, 0, w, h]], scale)
+        return [self._recognize(image, boxes)]
+
+    def process_bibs(self, image, image_path, logger, face_areas=None):
+        """ocr.mode 为 regions 且给出了人脸位置时只识别人脸下方区域，否则整图 OCR"""
         try:
-            result = self.ocr.ocr(image)
+            start = time.perf_counter()
+            if self.config['ocr'].get('mode', 'full') == 'regions' and face_areas is not None:
+                result = self._ocr_regions(image, face_areas)
+                self._add_stat('ocr_region_photos', 1)
+            else:
+                result = self.ocr.ocr(image)
+            self._add_stat('ocr_ms', (time.perf_counter() - start) * 1000)
             bibs = set()
             if result and result[0]:
                 for line in result[0]:
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import threading
+
+def model_fingerprint(config):
+    """Hash of every setting that changes face or bib results, part of each cache key."""
+    deepface = config['deepface']
+    ocr = config['ocr']
+    settings = {
+        'model': deepface['model'],
+        'detector': deepface['detector'],
+        'alignment': deepface['alignment'],
+        'expand_percentage': deepface['expand_percentage'],
+        'detect_confidence': deepface['detect_confidence'],
+        'embedding_format': deepface.get('embedding_format', 'json'),
+        'ocr_min_size': ocr['min_size'],
+        'ocr_max_size': ocr['max_size'],
+        'ocr_confidence': ocr['confidence'],
+        'ocr_mode': [ocr.get(k) for k in ('mode', 'torso', 'fallback_width')],
+        'quality': config.get('quality', {}),
+        'inference': [config.get('inference', {}).get(k) for k in ('backend', 'quantized', 'ocr_onnx')],
+        'max_width': config.get('image', {}).get('max_width', 2000),
+        'detect_width': config.get('image', {}).get('detect_width', 0),
+        'ocr_width': config.get('image', {}).get('ocr_width', 0),
+        'cascade': [config.get('cascade', {}).get(k) for k in ('enabled', 'backend', 'width', 'margin', 'max_area', 'min_size', 'min_neighbors', 'score')],
+        'burst': [config.get('burst', {}).get(k) for k in ('enabled', 'hash_distance', 'max_diff')],
+    }
+    return hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()[:16]
+
+def bytes_hash(buf):
+    return 'sha256:' + hashlib.sha256(buf).hexdigest()
+
+class ResultCache:
+    """On-disk photo result cache keyed by photo content hash and model fingerprint.
+
+    Entries are small json files spread over 256 sub directories. Reads refresh the
+    file mtime, and the oldest entries are evicted once the cache grows past max_bytes.
+    Several worker processes can share one cache directory.
+    """
+    def __init__(self, cache_dir, max_bytes, fingerprint):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for _, size, _ in self._entries())
+
+    def _path(self, content_hash):
+        key = hashlib.sha256(f"{content_hash}:{self.fingerprint}".encode()).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.json')
+
+    def _entries(self):
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_size, stat.st_mtime
+
+    def get(self, content_hash):
+        path = self._path(content_hash)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            os.utime(path)
+            return data
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, content_hash, data):
+        path = self._path(content_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += size
+            if self.size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Other workers write to the same directory, so recount from disk before evicting
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        self.size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for path, size, _ in entries:
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except FileNotFoundError:
+                pass
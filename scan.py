@@ -1,21 +1,33 @@
 import argparse
+import io
 import os
 import cv2
 import multiprocessing.queues
+import queue
+import threading
 import traceback
 import psutil
 import time
 import asyncio
 import numpy as np
 import json
-from multiprocessing import Process, Manager, set_start_method
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Event, Process, Manager, Pipe, Queue, parent_process, set_start_method, set_forkserver_preload
+from multiprocessing.connection import wait
 from utils import setup_logging
 from datetime import datetime
 from config import config
-from client_api import ClientAPI
+from client_api import ClientAPI, ResultBuffer
 from gdrive import GoogleDrive
 from gphoto import GooglePhotos
-from PIL import Image
+from embedding_codec import encode_embedding
+from embedding_server import EmbeddingClient, embedding_server_process
+from result_cache import ResultCache, bytes_hash, model_fingerprint
+from scan_results import ResultLog, journal_state, result_files
+from burst import BurstTracker, group_bursts, same_results
+from threads import apply_thread_budget, thread_budget
+from PIL import Image, ImageOps
 from pillow_heif import register_heif_opener
 
 register_heif_opener()
@@ -25,204 +37,937 @@ def is_heic_file(file_path):
     extension = os.path.splitext(file_path)[1].lower()
     return extension == '.heic'
 
-def load_heic_image(file_path):
+EXIF_ORIENTATION = 0x0112
+REDUCED_MODES = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+def apply_orientation(img, orientation):
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.transpose(img)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.transpose(img), -1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+def resize_to_width(img, max_width):
+    height, width = img.shape[:2]
+    if not max_width or width <= max_width:
+        return img
+    new_height = int(height * max_width / width)
+    return cv2.resize(img, (max_width, new_height), interpolation=cv2.INTER_AREA)
+
+def load_heic_image(buf, max_width=None):
     try:
-        pil_image = Image.open(file_path).convert('RGB')
-        img_array = np.array(pil_image)
-        img_bgr = cv2.cvtColor(img_array, cv2.COLOR_RGB2BGR)
+        pil_image = Image.open(io.BytesIO(buf))
+        pil_image = ImageOps.exif_transpose(pil_image)
+        if max_width and pil_image.width > max_width:
+            pil_image = pil_image.resize((max_width, int(pil_image.height * max_width / pil_image.width)), Image.BOX)
+        img_bgr = cv2.cvtColor(np.asarray(pil_image.convert('RGB')), cv2.COLOR_RGB2BGR)
         return img_bgr
     except Exception as e:
         print(f"Error loading HEIC image: {e}")
         return None
-    
-def open_image(f):
-    print(f)
-    if is_heic_file(f):
-        return load_heic_image(f)
-    else:
-        return cv2.imread(f)
 
+def reduced_decode_flag(width, max_width):
+    """Largest libjpeg reduction (1/8, 1/4, 1/2) that still decodes at least max_width wide."""
+    if max_width:
+        for factor, mode in REDUCED_MODES:
+            if width / factor >= max_width:
+                return mode
+    return cv2.IMREAD_COLOR
+
+def decode_image(buf, name, max_width=None):
+    """Decode an in-memory photo to BGR, EXIF orientation applied and at most max_width wide.
+
+    JPEGs much larger than max_width are decoded at 1/2, 1/4 or 1/8 scale by libjpeg
+    directly, which skips most of the decode work and memory of a full size frame.
+    """
+    if is_heic_file(name):
+        return load_heic_image(buf, max_width)
+    orientation = 1
+    flags = cv2.IMREAD_COLOR
+    try:
+        # Only parses the header, pixels are decoded by OpenCV below
+        header = Image.open(io.BytesIO(buf))
+        orientation = header.getexif().get(EXIF_ORIENTATION, 1)
+        width, height = header.size
+        if orientation in (5, 6, 7, 8):
+            width = height
+        flags = reduced_decode_flag(width, max_width)
+    except Exception:
+        pass
+    img = cv2.imdecode(np.frombuffer(buf, dtype=np.uint8), flags | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        return None
+    return resize_to_width(apply_orientation(img, orientation), max_width)
+
+def open_image(f, max_width=None):
+    with open(f, 'rb') as fh:
+        return decode_image(fh.read(), f, max_width)
+
+class WorkerChannel:
+    """Sending end of a worker's result pipe, shared by the inference and upload threads.
+
+    Every message doubles as a heartbeat for the master watchdog:
+      ('ready', load_time)            models loaded, worker is taking photos
+      ('stage', photo_id, stage)      worker started a stage of a photo
+      ('result', photo_id, status)    photo finished, status < 0 on failure
+      ('count', name, n)              add n to a scan summary counter
+      ('memory', rss_mb)              worker RSS after a photo
+      ('retire', reason)              worker takes no more photos and exits once its pending ones are done
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def put(self, msg):
+        with self.lock:
+            self.conn.send(msg)
+
+    def ready(self, load_time):
+        self.put(('ready', load_time))
+
+    def stage(self, photo_id, stage):
+        self.put(('stage', photo_id, stage))
+
+    def result(self, photo_id, status):
+        self.put(('result', photo_id, status))
+
+    def count(self, name, n=1):
+        self.put(('count', name, n))
+
+    def memory(self, rss_mb):
+        self.put(('memory', rss_mb))
+
+    def retire(self, reason):
+        self.put(('retire', reason))
+
+_thread_local = threading.local()
+
+def _storage_client(storage_type):
+    # googleapiclient services are not thread safe, each download thread builds its own
+    if storage_type == 1:
+        if not hasattr(_thread_local, 'gdrive'):
+            _thread_local.gdrive = GoogleDrive()
+        return _thread_local.gdrive
+    if storage_type == 2:
+        if not hasattr(_thread_local, 'gphoto'):
+            _thread_local.gphoto = GooglePhotos()
+        return _thread_local.gphoto
+    raise ValueError(f"Unsupported storage type {storage_type}")
+
+def download_photo(p):
+    client = _storage_client(p['storage_type'])
+    buf = client.download_bytes(p['gdid'])
+    if buf is None:
+        raise IOError(f"Download failed: {p['name']} ({p['gdid']})")
+    return buf
+
+def open_result_cache():
+    cache_config = config.get('cache', {})
+    if not cache_config.get('enabled', False):
+        return None
+    return ResultCache(cache_config.get('dir', './cache'), cache_config.get('max_mb', 2048) * 1024 * 1024,
+                       model_fingerprint(config))
+
+class PhotoPrefetcher:
+    """Keeps `depth` photos downloading ahead of the inference loop."""
+    def __init__(self, worker_id, photo_queue, channel, logger, depth=2, threads=2, cache=None, retire_event=None):
+        self.worker_id = worker_id
+        self.retire_event = retire_event
+        self.retiring = False
+        self.photo_queue = photo_queue
+        self.channel = channel
+        self.logger = logger
+        self.cache = cache
+        self.depth = max(depth, 1)
+        self.pool = ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix=f"download_{worker_id}")
+        self.pending = deque()
+        self.exhausted = False
+
+    def _cached(self, p, content_hash):
+        data = self.cache.get(content_hash)
+        self.channel.count('cache_hits' if data is not None else 'cache_misses')
+        if data is not None:
+            self.logger.info(f"Worker {self.worker_id} cache hit for {p['name']} ({content_hash})")
+        return data
+
+    def _download(self, p):
+        """Returns {'buffer', 'hash', 'cached'}, cached holds the stored result on a cache hit."""
+        self.channel.stage(p['id'], 'download')
+        content_hash = None
+        if self.cache is not None and p['storage_type'] == 1:
+            # Drive knows the md5 of the content, a hit skips the download as well
+            md5 = _storage_client(1).get_md5(p['gdid'])
+            if md5:
+                content_hash = 'md5:' + md5
+                data = self._cached(p, content_hash)
+                if data is not None:
+                    return {'buffer': None, 'hash': content_hash, 'cached': data}
+        self.logger.info(f"Download file from cloud storage: {p['name']}")
+        buf = download_photo(p)
+        data = None
+        if self.cache is not None and content_hash is None:
+            content_hash = bytes_hash(buf)
+            data = self._cached(p, content_hash)
+        return {'buffer': buf, 'hash': content_hash, 'cached': data}
+
+    def _fill(self):
+        # The master only sends sentinels once every photo is accounted for, stuck photos
+        # can still be requeued, so an empty queue is waited out while we have nothing to do.
+        while not self.exhausted and len(self.pending) < self.depth:
+            if self.retire_event is not None and self.retire_event.is_set() and not self.retiring:
+                self.logger.info(f"Worker {self.worker_id} asked to retire by the master")
+                self.retire()
+                break
+            try:
+                p = self.photo_queue.get(timeout=1 if not self.pending else 0.01)
+            except multiprocessing.queues.Empty:
+                if self.pending:
+                    break
+                if not parent_process().is_alive():
+                    self.logger.info(f"Worker {self.worker_id} lost its master, exiting")
+                    self.exhausted = True
+                continue
+            if p is None:
+                self.logger.info(f"Worker {self.worker_id} received sentinel(None) value")
+                self.exhausted = True
+                break
+            # A list is a burst of near identical frames, they stay together in this worker
+            burst = p if isinstance(p, list) else [p]
+            for p in burst:
+                self.logger.info(f"Worker {self.worker_id} received photo: {p['name']} ({p['id']} / {p['gdid']})")
+                self.channel.stage(p['id'], 'queued')
+                self.pending.append((p, self.pool.submit(self._download, p), burst[0]['id']))
+
+    def retire(self):
+        """Stop taking photos, the pending ones are still handed out by next()."""
+        self.retiring = True
+        self.exhausted = True
+
+    def next(self):
+        self._fill()
+        if not self.pending:
+            return None
+        item = self.pending.popleft()
+        self._fill()
+        return item
+
+    def close(self):
+        self.pool.shutdown(wait=True)
+
+class ResultUploader:
+    """Uploads photo results from a background thread so inference never waits on the API.
+
+    With a journal, uploaded results are acknowledged in it, and results that fail to upload
+    stay there unacknowledged for 'mphoto.py sync' instead of failing the photo.
+    """
+    def __init__(self, worker_id, channel, logger, max_pending=8, journal=None):
+        self.worker_id = worker_id
+        self.journal = journal
+        self.channel = channel
+        self.logger = logger
+        self.queue = queue.Queue(maxsize=max(max_pending, 1))
+        self.thread = threading.Thread(target=self._run, name=f"upload_{worker_id}", daemon=True)
+        self.thread.start()
+
+    def submit(self, p, data):
+        self.queue.put((p, data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _flush(self, buffer):
+        photo_ids = [photo_id for photo_id, _ in buffer.items]
+        try:
+            buffer.flush()
+            self.logger.info(f"Worker {self.worker_id} uploaded {len(photo_ids)} photo results: {photo_ids}")
+            status = 0
+            if self.journal is not None:
+                self.journal.ack(photo_ids)
+        except Exception as e:
+            self.logger.error(f"Worker {self.worker_id} upload error for photos {photo_ids}: {str(e)}\n{traceback.format_exc()}")
+            status = -1
+            if self.journal is not None:
+                self.logger.warning(f"Worker {self.worker_id} left {len(photo_ids)} results in the journal for 'mphoto.py sync'")
+                self.channel.count('uploads_deferred', len(photo_ids))
+                status = 0
+        for photo_id in photo_ids:
+            self.channel.result(photo_id, status)
+
+    def _run(self):
+        api = config['api']
+        buffer = ResultBuffer(ClientAPI(), api.get('bulk_size', 20), api.get('bulk_wait', 5))
+        while True:
+            try:
+                item = self.queue.get(timeout=buffer.time_left())
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                p, data = item
+                self.channel.stage(p['id'], 'upload')
+                self.logger.info(f"Worker {self.worker_id} Add photo result: {p['name']} ({p['id']} / {p['gdid']})")
+                buffer.add(p['id'], data)
+            if buffer.is_due():
+                self._flush(buffer)
+        self._flush(buffer)
 
+def configure_start_method():
+    # forkserver forks workers from a server that already imported TensorFlow, Paddle and DeepFace,
+    # so a new or restarted worker only pays for loading model weights
+    parallel = config.get('parallel', {})
+    method = parallel.get('start_method', 'forkserver')
+    try:
+        set_start_method(method)
+    except RuntimeError:
+        pass
+    except ValueError:
+        set_start_method('spawn', force=True)
+    if method == 'forkserver':
+        set_forkserver_preload(parallel.get('preload', ['scan', 'processor']))
 
-def worker_process(worker_id, photo_queue, result_queue):
+def worker_process(worker_id, photo_queue, result_conn, embedding_queues=None, cloud_storage_id=None, budget=None,
+                   retire_event=None):
+    load_start = time.time()
+    channel = WorkerChannel(result_conn)
     logger = setup_logging(f"{config['logging']['scan_prefix']}_worker_{worker_id}")
+    if budget is not None:
+        apply_thread_budget(budget)
+        logger.info(f"Worker {worker_id} thread budget: {budget}")
     from processor import ImageProcessor
-    processor = ImageProcessor(config, logger)
-    logger.info(f"Worker {worker_id} started")
-    gclient = GoogleDrive()
-    gphotot = GooglePhotos()
-    mclient = ClientAPI()
+    embedder = None
+    if embedding_queues:
+        request_queue, reply_queue = embedding_queues
+        embedder = EmbeddingClient(worker_id, request_queue, reply_queue,
+                                   config.get('embedding_server', {}).get('timeout', 60))
+    processor = ImageProcessor(config, logger, embedder,
+                               cpu_threads=budget['ocr'] if budget else None,
+                               embed_threads=budget['tf_intra'] if budget else None)
+    parallel = config.get('parallel', {})
+    if parallel.get('warm_up', True):
+        processor.warm_up()
+    load_time = time.time() - load_start
+    logger.info(f"Worker {worker_id} started, models loaded in {load_time:.2f} seconds")
+    channel.ready(load_time)
+    cache = open_result_cache()
+    results_config = config.get('results', {})
+    result_log = None
+    if results_config.get('enabled', True) and cloud_storage_id is not None:
+        result_log = ResultLog(results_config.get('dir', './results'), cloud_storage_id, worker_id,
+                               results_config.get('fsync', False))
+    # Without uploads the journal is the only output, 'mphoto.py sync' sends it later
+    upload = result_log is None or results_config.get('upload', True)
+    prefetcher = PhotoPrefetcher(worker_id, photo_queue, channel, logger,
+                                 depth=parallel.get('prefetch', 2),
+                                 threads=parallel.get('download_threads', 2),
+                                 cache=cache, retire_event=retire_event)
+    uploader = ResultUploader(worker_id, channel, logger, max_pending=parallel.get('upload_queue', 8), journal=result_log)
+    embedding_format = config['deepface'].get('embedding_format', 'json')
+    max_width = config.get('image', {}).get('max_width', 2000)
+    detect_width = config.get('image', {}).get('detect_width', 0)
+    ocr_width = config.get('image', {}).get('ocr_width', 0)
+    burst_config = config.get('burst', {})
+    tracker = None
+    if burst_config.get('enabled', False):
+        tracker = BurstTracker(burst_config.get('hash_distance', 6), burst_config.get('max_diff', 8.0),
+                               burst_config.get('verify_every', 10))
+    process = psutil.Process()
+    # TF/Paddle workers slowly grow, a worker past these limits is replaced by a fresh one
+    memory_config = config.get('memory', {})
+    max_photos = memory_config.get('max_photos', 0)
+    max_rss = memory_config.get('max_rss_mb', 0)
+    photos_done = 0
+    regions_ocr = config['ocr'].get('mode', 'full') == 'regions'
+    debug = config['deepface']['debug'] or config['ocr']['debug']
+    # Full-frame OCR does not need the faces, so it runs next to face processing;
+    # TensorFlow and Paddle release the GIL while they compute
+    stage_pool = None
+    if config.get('threads', {}).get('concurrent_stages', True) and not regions_ocr:
+        stage_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"ocr_{worker_id}")
+
+    def submit(p, data):
+        if upload:
+            uploader.submit(p, data)
+        else:
+            channel.count('uploads_deferred')
+            channel.result(p['id'], 0)
+
+    def infer(p, img, source, image_file, f_size):
+        # Faces are detected on img, embedded from source crops; bibs are read from source
+        bib_image = resize_to_width(source, ocr_width) if not regions_ocr and ocr_width else source
+        if debug and (bib_image is img or bib_image is source):
+            # Both stages only read the frame, except for debug drawing
+            bib_image = bib_image.copy()
+        channel.stage(p['id'], 'faces')
+        if stage_pool is not None:
+            bib_future = stage_pool.submit(processor.process_bibs, bib_image, image_file, logger)
+            face_embeddings, _ = processor.process_faces(img, image_file, logger, source)
+            channel.stage(p['id'], 'bibs')
+            bibs = bib_future.result()
+        else:
+            # Bib regions come from every detected face, also those the quality gate dropped
+            face_embeddings, face_areas = processor.process_faces(img, image_file, logger, source)
+            channel.stage(p['id'], 'bibs')
+            bibs = processor.process_bibs(bib_image, image_file, logger, face_areas)
+        for name, value in processor.pop_stats().items():
+            channel.count(name, value)
+        f_list = []
+        for (embedding, confidence, _) in face_embeddings:
+            face = encode_embedding(embedding, embedding_format, config['deepface']['embedding_dim'])
+            face['confidence'] = confidence
+            f_list.append(face)
+        b_list = []
+        for (bib_number, confidence) in bibs:
+            b = {}
+            b['bib_number'] = bib_number
+            b['confidence'] = confidence
+            b_list.append(b)
+        return {
+            'bib_photos': b_list,
+            'face_photos': f_list,
+            'photo_size': f_size
+        }
 
     while True:
-        try:
-            p = photo_queue.get(timeout=1)
-            if p is None:
-                logger.info(f"Worker {worker_id} received sentinel(None) value, exiting")
-                break
-            else:
-                logger.info(f"Worker {worker_id} received photo: {p['name']} ({p['id']} / {p['gdid']})")
-        except multiprocessing.queues.Empty:
-            logger.info(f"Worker {worker_id} found photo queue empty, exiting")
+        item = prefetcher.next()
+        if item is None:
             break
-            
+        p, download, burst = item
         try:
-            process = psutil.Process()
             mem_before = process.memory_info().rss / 1024 / 1024
             logger.info(f"Worker {worker_id} memory usage before processing {p['name']}: {mem_before:.2f} MB")
 
+            downloaded = download.result()
+            if downloaded['cached'] is not None:
+                if result_log is not None:
+                    result_log.append(p, downloaded['cached'])
+                submit(p, downloaded['cached'])
+                continue
+            # Only used to name debug images, the photo itself never touches the disk
             image_file = os.path.join(tmp_dir, p['name'])
-            logger.info(f"Download file from google drive: {image_file}")
-            if p['storage_type'] == 1:
-                gclient.download(p['gdid'], image_file)
-            elif p['storage_type'] == 2:
-                gphotot.download(p['gdid'], image_file)
-            else:
-                logger.info(f"Unsupported storage type {p['storage_type']}")
-                break
-            
-            img = open_image(image_file)
-            if img is None:
+            channel.stage(p['id'], 'decode')
+            source = decode_image(downloaded['buffer'], p['name'], max_width)
+            if source is None:
                 logger.error(f"Worker {worker_id} failed to load image: {p['name']}")
-                result_queue.put((p['name'], -1))
+                channel.result(p['id'], -1)
                 continue
-            
-            height, width = img.shape[:2]
-            if width > 2000:
-                scale = 2000 / width
-                new_width = 2000
-                new_height = int(height * scale)
-                img = cv2.resize(img, (new_width, new_height), interpolation=cv2.INTER_AREA)
-                logger.debug(f"Worker {worker_id} resized {image_file} from {width}x{height} to {new_width}x{new_height}")
-            
-            img2 = img.copy()
-            face_embeddings = processor.process_faces(img, image_file, logger)
-            bibs = processor.process_bibs(img2, image_file, logger)
-            f_list = []
-            for (embedding, confidence) in face_embeddings:
-                face = {}
-                face['embedding'] = embedding.tolist()
-                face['confidence'] = confidence
-                f_list.append(face)
-            b_list = []
-            for (bib_number, confidence) in bibs:
-                b = {}
-                b['bib_number'] = bib_number
-                b['confidence'] = confidence
-                b_list.append(b)
-            f_size = os.path.getsize(image_file)
+            img = resize_to_width(source, detect_width) if detect_width else source
+            logger.debug(f"Worker {worker_id} decoded {p['name']} to {source.shape[1]}x{source.shape[0]}, detecting at {img.shape[1]}x{img.shape[0]}")
+            f_size = len(downloaded['buffer'])
             logger.info(f"File size: {f_size}")
-            data = {
-                'bib_photos': b_list,
-                'face_photos': f_list,
-                'photo_size': f_size
-            }
-            logger.info(f"Add photo result:")
-            logger.info(f"Worker {worker_id} Add photo result: {p['name']} ({p['id']} / {p['gdid']})")
-            logger.info(f"  found bibs: {len(b_list)}")
-            logger.info(f"  found faces: {len(f_list)}")
-            mclient.add_photo_result(p['id'], data)
-            mem_after = process.memory_info().rss / 1024 / 1024
-            result_queue.put((p['name'], 0))
-            logger.info(f"Worker {worker_id} memory usage after processing {p['name']}: {mem_after:.2f} MB")
+
+            data = None
+            burst_of = None
+            if tracker is not None:
+                signature = tracker.signature(img)
+                representative = tracker.match(burst, signature)
+                if representative is not None:
+                    burst_of, rep_data = representative
+                    data = {**rep_data, 'photo_size': f_size}
+                    if tracker.should_verify():
+                        # Spot check: run the models anyway and compare with the reused result
+                        full = infer(p, img, source, image_file, f_size)
+                        channel.count('burst_verified')
+                        if not same_results(data, full):
+                            channel.count('burst_mismatches')
+                            logger.warning(f"Worker {worker_id} burst result of {burst_of} does not match {p['name']}")
+                            tracker.represent(p['id'], signature, full)
+                            data, burst_of = full, None
+                    if burst_of is not None:
+                        channel.count('burst_reused')
+                        logger.info(f"Worker {worker_id} reused the results of photo {burst_of} for {p['name']}")
+            if data is None:
+                data = infer(p, img, source, image_file, f_size)
+                if tracker is not None:
+                    tracker.represent(p['id'], signature, data)
+                if cache is not None:
+                    cache.put(downloaded['hash'], data)
+            logger.info(f"Worker {worker_id} queue photo result: {p['name']} ({p['id']} / {p['gdid']})")
+            logger.info(f"  found bibs: {len(data['bib_photos'])}")
+            logger.info(f"  found faces: {len(data['face_photos'])}")
+            if result_log is not None:
+                # Burst linkage and quality gate drops are only kept locally, the API gets the plain result.
+                # A reused frame ran no quality gate, last_face_drops belongs to another photo.
+                if burst_of is not None:
+                    local = {**data, 'burst_of': burst_of}
+                else:
+                    local = {**data, 'face_drops': processor.last_face_drops}
+                result_log.append(p, local)
+            submit(p, data)
         except Exception as e:
             logger.error(f"Worker {worker_id} error for {p['name']}: {str(e)}\n{traceback.format_exc()}")
-            result_queue.put((p['name'], -1))
+            channel.result(p['id'], -1)
+        finally:
+            photos_done += 1
+            mem_after = process.memory_info().rss / 1024 / 1024
+            logger.info(f"Worker {worker_id} memory usage after processing {p['name']}: {mem_after:.2f} MB")
+            channel.memory(mem_after)
+            if not prefetcher.retiring and ((max_photos and photos_done >= max_photos) or (max_rss and mem_after > max_rss)):
+                reason = f"{photos_done} photos" if max_photos and photos_done >= max_photos else f"RSS {mem_after:.0f} MB"
+                logger.info(f"Worker {worker_id} retiring after {reason}")
+                channel.retire(reason)
+                prefetcher.retire()
         logger.debug(f"Worker {worker_id}: Send status sync")
+    prefetcher.close()
+    uploader.close()
+    if stage_pool is not None:
+        stage_pool.shutdown(wait=True)
+    if result_log is not None:
+        result_log.close()
     logger.info(f"Worker {worker_id} completed and exiting")
 
 class Scaner:
     def __init__(self, cloud_storage_id):
         self.logger = setup_logging(config['logging']['scan_prefix'])
         self.sync_timeout = config.get('sync_timeout', 60)
+        self.photo_retries = config.get('photo_retries', 2)
+        self.worker_restarts = config.get('worker_restarts', 5)
         self.cloud_storage_id = cloud_storage_id
         self.total_photos = 0
         self.processed_count = 0
         self.incomplete_count = 0
+        self.requeued_count = 0
         self.update_list = []
         self.mclient = ClientAPI()
+        self.photos = {}
+        self.finished = set()
+        self.retries = {}
+        self.restarts = {}
+        self.workers = {}
+        self.conns = {}
+        self.worker_status = {}
+        self.worker_ready = {}
+        self.inflight = {}
+        self.worker_started = {}
+        self.startup_times = []
+        self.load_times = []
+        self.counters = {}
+        self.embedding_server = None
+        self.embedding_queues = None
+        self.thread_budget = None
+        self.retire_events = {}
+        self.retiring = {}
+        self.worker_rss = {}
+        self.peak_rss = 0
+        self.max_workers = 0
+        self.last_autoscale = 0
+        memory_config = config.get('memory', {})
+        self.worker_mb = memory_config.get('worker_mb', 2500)
+        self.reserve_mb = memory_config.get('reserve_mb', 1024)
+        self.incoming = queue.Queue()
+        self.feed_done = True
+        self.journaled = {}
+        self.skipped_count = 0
+        # Workers journal every result before uploading it
+        self.durable_uploads = config.get('results', {}).get('enabled', True)
 
     def print_summary(self):
         print(f"Total batch photos: {self.total_photos}")
         print(f"Total processed photos: {self.processed_count}")
         print(f"Failed photos count: {self.incomplete_count}")
+        print(f"Requeued photos count: {self.requeued_count}")
+        if self.skipped_count:
+            print(f"Skipped journaled photos: {self.skipped_count}")
+        if self.startup_times:
+            print(f"Worker starts: {len(self.startup_times)}, "
+                  f"startup avg {sum(self.startup_times) / len(self.startup_times):.2f}s / max {max(self.startup_times):.2f}s, "
+                  f"model load avg {sum(self.load_times) / len(self.load_times):.2f}s")
+        if self.peak_rss:
+            print(f"Peak worker RSS: {self.peak_rss:.0f} MB")
+        for name, value in sorted(self.counters.items()):
+            if name.endswith('_ms'):
+                print(f"{name}: {value:.0f} total")
+            else:
+                print(f"{name}: {value}")
+        dropped = sum(v for k, v in self.counters.items() if k.startswith('faces_dropped_'))
+        if dropped:
+            print(f"Faces dropped by the quality gate: {dropped}")
+        checked = self.counters.get('cascade_skipped', 0) + self.counters.get('cascade_passed', 0)
+        if checked:
+            print(f"Cascade skip rate: {self.counters.get('cascade_skipped', 0) / checked:.1%}")
         print(json.dumps(self.mclient.get_cloud_storage_detail(self.cloud_storage_id), indent=2))
 
-    async def scan_async(self):
+    def _start_embedding_server(self):
+        request_queue, reply_queues = self.embedding_queues
+        self.embedding_server = Process(target=embedding_server_process, args=(request_queue, reply_queues, config, self.thread_budget))
+        self.embedding_server.start()
+        self.logger.info("Started embedding server")
+
+    def _stop_embedding_server(self):
+        if self.embedding_server is None:
+            return
+        self.embedding_queues[0].put(None)
+        self.embedding_server.join(timeout=self.sync_timeout)
+        if self.embedding_server.is_alive():
+            self.embedding_server.kill()
+            self.embedding_server.join()
+        self.embedding_server = None
+
+    def _start_worker(self, worker_id, photo_queue):
+        recv_conn, send_conn = Pipe(duplex=False)
+        embedding_queues = None
+        if self.embedding_queues:
+            embedding_queues = (self.embedding_queues[0], self.embedding_queues[1][worker_id])
+        self.retire_events[worker_id] = Event()
+        p = Process(target=worker_process, args=(worker_id, photo_queue, send_conn, embedding_queues, self.cloud_storage_id,
+                                                 self.thread_budget, self.retire_events[worker_id]))
+        p.start()
+        # Drop our copy of the sending end so recv() sees EOF once the worker is gone
+        send_conn.close()
+        self.workers[worker_id] = p
+        self.conns[worker_id] = recv_conn
+        # Model loading gets master_wait_for on top of the usual heartbeat timeout
+        self.worker_status[worker_id] = time.time() + config['master_wait_for']
+        self.worker_ready[worker_id] = False
+        self.worker_started[worker_id] = time.time()
+        self.inflight[worker_id] = {}
+
+    def _finish_photo(self, photo_id, status):
+        if photo_id in self.finished:
+            return
+        self.finished.add(photo_id)
+        self.processed_count += 1
+        if status < 0:
+            self.incomplete_count += 1
+        self.logger.debug(f"Processed {self.processed_count}/{len(self.update_list)} photos")
+
+    def _handle_message(self, worker_id, msg):
+        self.worker_status[worker_id] = time.time()
+        kind = msg[0]
+        if kind == 'ready':
+            self.worker_ready[worker_id] = True
+            startup = time.time() - self.worker_started[worker_id]
+            self.startup_times.append(startup)
+            self.load_times.append(msg[1])
+            self.logger.info(f"Worker {worker_id} is ready after {startup:.2f} seconds (model load {msg[1]:.2f} seconds)")
+        elif kind == 'stage':
+            _, photo_id, stage = msg
+            self.inflight[worker_id][photo_id] = stage
+            self.logger.debug(f"Worker {worker_id} photo {photo_id}: {stage}")
+        elif kind == 'result':
+            _, photo_id, status = msg
+            self.inflight[worker_id].pop(photo_id, None)
+            self._finish_photo(photo_id, status)
+        elif kind == 'count':
+            _, name, n = msg
+            self.counters[name] = self.counters.get(name, 0) + n
+        elif kind == 'memory':
+            self.worker_rss[worker_id] = msg[1]
+            self.peak_rss = max(self.peak_rss, msg[1])
+        elif kind == 'retire':
+            self.retiring.setdefault(worker_id, 'recycle')
+            self.logger.info(f"Worker {worker_id} is retiring after {msg[1]}")
+
+    def _drain(self, worker_id):
+        conn = self.conns.get(worker_id)
+        if conn is None:
+            return
+        try:
+            while conn.poll():
+                self._handle_message(worker_id, conn.recv())
+        except (EOFError, OSError):
+            conn.close()
+            del self.conns[worker_id]
+
+    def _stop_worker(self, worker_id):
+        p = self.workers.pop(worker_id)
+        if p.is_alive():
+            p.kill()
+        p.join()
+        self._drain(worker_id)
+        conn = self.conns.pop(worker_id, None)
+        if conn is not None:
+            conn.close()
+        self.worker_status.pop(worker_id, None)
+        self.worker_ready.pop(worker_id, None)
+        self.worker_rss.pop(worker_id, None)
+        self.retire_events.pop(worker_id, None)
+        # Whatever the retirement was for, it ends with the process
+        self.retiring.pop(worker_id, None)
+        return self.inflight.pop(worker_id, {})
+
+    def _requeue(self, photo_ids, photo_queue):
+        for photo_id in photo_ids:
+            if photo_id in self.finished:
+                continue
+            p = self.photos.get(photo_id)
+            if p is None:
+                continue
+            self.retries[photo_id] = self.retries.get(photo_id, 0) + 1
+            if self.retries[photo_id] > self.photo_retries:
+                self.logger.warning(f"Photo {p['name']} ({photo_id}) gave up after {self.photo_retries} retries")
+                self._finish_photo(photo_id, -1)
+            else:
+                self.logger.info(f"Requeue photo {p['name']} ({photo_id}), retry {self.retries[photo_id]}")
+                self.requeued_count += 1
+                photo_queue.put(p)
+
+    def _recover_worker(self, worker_id, photo_queue):
+        scaled_down = self.retiring.get(worker_id) == 'scale_down'
+        inflight = self._stop_worker(worker_id)
+        if inflight:
+            self.logger.info(f"Worker {worker_id} left {len(inflight)} photos in flight: {inflight}")
+        self._requeue(list(inflight), photo_queue)
+        if scaled_down or (self.feed_done and self.processed_count >= len(self.update_list)):
+            return
+        self.restarts[worker_id] = self.restarts.get(worker_id, 0) + 1
+        if self.restarts[worker_id] > self.worker_restarts:
+            self.logger.error(f"Worker {worker_id} restarted {self.worker_restarts} times, not restarting again")
+            return
+        self._start_worker(worker_id, photo_queue)
+        self.logger.info(f"Restarted worker {worker_id}")
+
+    def _retired(self, worker_id, photo_queue):
+        """A worker left after retiring: a recycled one is replaced, a scaled down one is not."""
+        reason = self.retiring.pop(worker_id)
+        inflight = self._stop_worker(worker_id)
+        if inflight:
+            self._requeue(list(inflight), photo_queue)
+        if reason != 'recycle' or (self.feed_done and self.processed_count >= len(self.update_list)):
+            return
+        self.counters['workers_recycled'] = self.counters.get('workers_recycled', 0) + 1
+        self._start_worker(worker_id, photo_queue)
+        self.logger.info(f"Recycled worker {worker_id}")
+
+    def _footprint(self):
+        # Measured peak RSS of a worker once known, the configured estimate before that
+        return self.peak_rss * 1.1 if self.peak_rss else self.worker_mb
+
+    def _workers_for_memory(self, wanted):
+        available = psutil.virtual_memory().available / 1024 / 1024 - self.reserve_mb
+        return max(min(wanted, int(available // self._footprint())), 1)
+
+    def _autoscale(self, photo_queue, current_time):
+        """Keep reserve_mb of host memory free: retire a worker below it, add one when there is room and work."""
+        memory_config = config.get('memory', {})
+        if not memory_config.get('autoscale', True) or current_time - self.last_autoscale < memory_config.get('check_interval', 10):
+            return
+        self.last_autoscale = current_time
+        available = psutil.virtual_memory().available / 1024 / 1024
+        active = [worker_id for worker_id in self.workers if worker_id not in self.retiring]
+        if available < self.reserve_mb and len(active) > memory_config.get('min_workers', 1):
+            worker_id = max(active, key=lambda w: self.worker_rss.get(w, 0))
+            self.logger.warning(f"Only {available:.0f} MB memory available, retiring worker {worker_id}")
+            self.retiring[worker_id] = 'scale_down'
+            self.retire_events[worker_id].set()
+            self.counters['workers_scaled_down'] = self.counters.get('workers_scaled_down', 0) + 1
+        elif (len(self.workers) < self.max_workers and all(self.worker_ready.values())
+              and available - self._footprint() > self.reserve_mb * 1.5 and photo_queue.qsize() > len(active)):
+            # Slots that used up their crash restarts stay given up
+            free = [w for w in range(self.max_workers)
+                    if w not in self.workers and self.restarts.get(w, 0) <= self.worker_restarts]
+            if not free:
+                return
+            worker_id = free[0]
+            self.logger.info(f"{available:.0f} MB memory available, starting worker {worker_id}")
+            self._start_worker(worker_id, photo_queue)
+            self.counters['workers_scaled_up'] = self.counters.get('workers_scaled_up', 0) + 1
+
+    def _is_stuck(self, worker_id, current_time):
+        # An idle worker blocked on an empty queue is healthy, only busy or loading workers must heartbeat
+        if self.worker_ready[worker_id] and not self.inflight[worker_id]:
+            return False
+        # A journaled result is safe already: a slow API retrying an upload is no reason
+        # to kill the worker and infer its photos again
+        if (self.worker_ready[worker_id] and self.durable_uploads
+                and all(stage == 'upload' for stage in self.inflight[worker_id].values())):
+            return False
+        return current_time - self.worker_status[worker_id] > self.sync_timeout
+
+    def _requeue_lost(self, photo_queue, current_time):
+        # A worker killed between taking a photo and reporting it leaves a photo nobody owns.
+        # Once the queue is drained and every worker has been idle for a while, put those back.
+        if photo_queue.qsize() > 0 or any(self.inflight.values()) or not all(self.worker_ready.values()):
+            return
+        if current_time - max(self.worker_status.values()) < 5:
+            return
+        lost = [photo_id for photo_id in self.photos if photo_id not in self.finished]
+        if lost:
+            self.logger.warning(f"{len(lost)} photos were lost by killed workers")
+            self._requeue(lost, photo_queue)
+
+    def _queue_items(self, photos):
+        """Photos as queue items, bursts of consecutive frames go as one list to a single worker."""
+        burst_config = config.get('burst', {})
+        if not burst_config.get('enabled', False):
+            return photos
+        groups = group_bursts(photos, burst_config.get('max_gap', 2.0), burst_config.get('max_step', 2),
+                              burst_config.get('max_size', 10))
+        self.counters['bursts'] = self.counters.get('bursts', 0) + sum(len(g) > 1 for g in groups)
+        return [g if len(g) > 1 else g[0] for g in groups]
+
+    def _load_journal(self):
+        results_config = config.get('results', {})
+        if not results_config.get('enabled', True) or not results_config.get('resume', True):
+            return
+        files = result_files(results_config.get('dir', './results'), [self.cloud_storage_id])
+        self.journaled = journal_state(files)
+        self.logger.info(f"Result journal holds {len(self.journaled)} photos")
+
+    def _skip_journaled(self, photos):
+        """Photos whose current version has a result the resume sync could not send are not scanned again.
+
+        Acknowledged results are no reason to skip: a photo listed again had its server
+        result reset, or must be rescanned with other models.
+        """
+        todo = []
+        for p in photos:
+            entry = self.journaled.get(p['id'])
+            if (entry is not None and not entry['acked'] and entry['gdid'] == p['gdid']
+                    and entry['modified_time'] == p.get('modified_time')):
+                self.skipped_count += 1
+                continue
+            todo.append(p)
+        return todo
+
+    def _run_producer(self, producer, photo_queue):
+        seen = set()
+        def feed(photos):
+            photos = [p for p in self._skip_journaled(photos) if p['id'] not in seen]
+            seen.update(p['id'] for p in photos)
+            # Workers can start on them right away, the master registers them on its next wake up
+            for item in self._queue_items(photos):
+                photo_queue.put(item)
+            if photos:
+                self.incoming.put(photos)
+        try:
+            producer(feed)
+        except Exception as e:
+            self.logger.error(f"Photo producer failed: {str(e)}\n{traceback.format_exc()}")
+        finally:
+            self.incoming.put(None)
+
+    def _register_incoming(self):
+        while True:
+            try:
+                photos = self.incoming.get_nowait()
+            except queue.Empty:
+                return
+            if photos is None:
+                self.feed_done = True
+                self.logger.info(f"Photo producer finished, {len(self.update_list)} photos to process")
+                continue
+            for p in photos:
+                self.photos[p['id']] = p
+            self.update_list += photos
+            self.total_photos = len(self.update_list)
+            self.logger.info(f"Received {len(photos)} photos, {self.total_photos} in total")
+
+    def _wait_events(self, timeout):
+        waitables = list(self.conns.values()) + [p.sentinel for p in self.workers.values()]
+        if not waitables:
+            return []
+        return wait(waitables, timeout)
+
+    async def scan_async(self, producer=None):
+        """Scan update_list, or the photos a producer(feed) running in a thread passes to feed()."""
         total_memory = psutil.virtual_memory().total / 1024 / 1024
         self.logger.info(f"Total system memory: {total_memory:.2f} MB")
     
         manager = Manager()
         photo_queue = manager.Queue()
-        result_queue = manager.Queue()
     
-        for p in self.update_list:
-            photo_queue.put(p)
+        self.photos = {p['id']: p for p in self.update_list}
+        for item in self._queue_items(self.update_list):
+            photo_queue.put(item)
         
         parallel_workers = config.get('parallel', {}).get('workers', 4)
         available_cores = os.cpu_count()
-        parallel_workers = min(parallel_workers, available_cores, int(self.total_photos / 2) or 1)
-        for _ in range(parallel_workers):
-            photo_queue.put(None)
-        self.logger.info(f"Loaded {len(self.update_list)} photos into queue with {parallel_workers} sentinels")
-    
-        self.logger.info(f"Starting {parallel_workers} worker processes (CPU cores: {available_cores}, images: {self.total_photos})")
+        if producer is None:
+            parallel_workers = min(parallel_workers, available_cores, int(self.total_photos / 2) or 1)
+        else:
+            parallel_workers = min(parallel_workers, available_cores)
+            self.feed_done = False
+            threading.Thread(target=self._run_producer, args=(producer, photo_queue), name="producer", daemon=True).start()
+        self.logger.info(f"Loaded {len(self.update_list)} photos into queue")
+
+        # parallel_workers is the most the pool grows to, memory decides how many start
+        self.max_workers = parallel_workers
+        start_workers = self._workers_for_memory(parallel_workers)
+        self.logger.info(f"Starting {start_workers} of up to {parallel_workers} worker processes (CPU cores: {available_cores}, "
+                         f"images: {self.total_photos}, {psutil.virtual_memory().available / 1024 / 1024:.0f} MB available)")
     
         os.makedirs(tmp_dir, exist_ok=True)
-        worker_status = {}
-        workers = {}
-        for i in range(parallel_workers):
-            p = Process(target=worker_process, args=(i, photo_queue, result_queue))
-            p.start()
-            workers[i] = p
-            worker_status[i] = time.time() + config['master_wait_for']
-    
+        threads_config = config.get('threads', {})
+        if threads_config.get('enabled', True):
+            server = 1 if config.get('embedding_server', {}).get('enabled', False) else 0
+            self.thread_budget = thread_budget(parallel_workers + server, threads_config)
+            self.logger.info(f"Thread budget per process: {self.thread_budget}")
+        if config.get('embedding_server', {}).get('enabled', False):
+            # Faces are detected in the workers and embedded in one shared process in batches
+            self.embedding_queues = (Queue(), {i: Queue() for i in range(parallel_workers)})
+            self._start_embedding_server()
+        for i in range(start_workers):
+            self._start_worker(i, photo_queue)
+        self.last_autoscale = time.time()
+
+        loop = asyncio.get_running_loop()
         while True:
-            await asyncio.sleep(1)  # Async sleep
-            active_workers = sum(1 for p in workers.values() if p.is_alive())
-            self.logger.debug(f"Active workers: {active_workers}, processed: {self.processed_count}, failed: {self.incomplete_count}, total: {len(self.update_list)}")
-        
-            # Check completion 
-            current_time = time.time()
-            completed = False
-            if (photo_queue.qsize() <= 0 and active_workers <= 0) or (self.processed_count + self.incomplete_count >= len(self.update_list)):
+            # Wake up as soon as any worker sends a message or exits, at least once per second for the watchdog
+            ready = await loop.run_in_executor(None, self._wait_events, 1)
+            self._register_incoming()
+            sentinels = {p.sentinel: worker_id for worker_id, p in self.workers.items()}
+            conn_ids = {id(conn): worker_id for worker_id, conn in self.conns.items()}
+            for obj in ready:
+                if id(obj) in conn_ids:
+                    self._drain(conn_ids[id(obj)])
+            for obj in ready:
+                if obj in sentinels:
+                    # Workers only leave on their own after the final sentinels, anything earlier is a crash
+                    worker_id = sentinels[obj]
+                    if worker_id in self.retiring:
+                        self.logger.info(f"Worker {worker_id} retired with code {self.workers[worker_id].exitcode}")
+                        self._retired(worker_id, photo_queue)
+                        continue
+                    self.logger.warning(f"Worker {worker_id} exited with code {self.workers[worker_id].exitcode}")
+                    self._recover_worker(worker_id, photo_queue)
+
+            if self.embedding_server is not None and not self.embedding_server.is_alive():
+                self.logger.warning(f"Embedding server exited with code {self.embedding_server.exitcode}, restarting")
+                self._start_embedding_server()
+
+            self.logger.debug(f"Active workers: {len(self.workers)}, processed: {self.processed_count}, failed: {self.incomplete_count}, total: {len(self.update_list)}")
+
+            # Check completion
+            if self.feed_done and self.processed_count >= len(self.update_list):
                 self.logger.info(f"All photos accounted for: processed {self.processed_count}, incomplete {self.incomplete_count}, total {len(self.update_list)}")
-                completed = True
-            if completed:
-                await asyncio.sleep(5)
-                for worker_id, p in workers.items():
-                    if p.is_alive():
-                        self.logger.info(f"Terminating worker {worker_id}")
-                        p.kill()
-                        p.join()
+                break
+            if not self.workers:
+                self._register_incoming()
+                self.logger.error(f"No worker left, {len(self.update_list) - self.processed_count} photos not processed")
+                self.incomplete_count += len(self.update_list) - self.processed_count
                 break
 
-            # Kill hanging worker and create new worker
-            for worker_id, last_updated in list(worker_status.items()):
-                if current_time - last_updated > self.sync_timeout:
-                    last_update = datetime.fromtimestamp(last_updated).strftime('%c')
-                    self.logger.warning(f"Worker {worker_id} timed out (last updated {last_update})")
-                    workers[worker_id].kill()
-                    workers[worker_id].join()
-                    self.incomplete_count += 1
-                
-                    worker_status[worker_id] = time.time() + config['master_wait_for']
-                    new_p = Process(target=worker_process, args=(worker_id, photo_queue, result_queue))
-                    new_p.start()
-                    workers[worker_id] = new_p
-                    self.logger.info(f"Restarted worker {worker_id}")
-            
-            try:
-                _, status = result_queue.get(timeout=1)
-                self.processed_count += 1
-                if status < 0:
-                    self.incomplete_count += 1
-                self.logger.debug(f"Processed {self.processed_count}/{len(self.update_list)} photos")
+            # Kill workers that stopped making progress and hand their photos to the others
+            current_time = time.time()
+            for worker_id in list(self.workers):
+                if self._is_stuck(worker_id, current_time):
+                    last_update = datetime.fromtimestamp(self.worker_status[worker_id]).strftime('%c')
+                    self.logger.warning(f"Worker {worker_id} timed out (last heartbeat {last_update}, in flight {self.inflight[worker_id]})")
+                    self._recover_worker(worker_id, photo_queue)
+            if self.workers:
+                self._requeue_lost(photo_queue, current_time)
+                self._autoscale(photo_queue, current_time)
 
-            except multiprocessing.queues.Empty:
-                pass
-            
-        for w in workers.values():
-            w.join()
+        for _ in self.workers:
+            photo_queue.put(None)
+        for worker_id, p in list(self.workers.items()):
+            p.join(timeout=self.sync_timeout)
+            if p.is_alive():
+                self.logger.info(f"Terminating worker {worker_id}")
+            self._stop_worker(worker_id)
+        self._stop_embedding_server()
     
         self.logger.info("Photo scanning completed")
         self.print_summary()
@@ -234,20 +979,26 @@ class Scaner:
 
         self.logger.info("Getting photo list...")
         self.update_list = self.mclient.list_photos(cloud_storage_id=self.cloud_storage_id, incomplete=True)
-        self.logger.info(f"Photos to update: {len(self.update_list)}")
+        self._load_journal()
+        self.update_list = self._skip_journaled(self.update_list)
+        self.logger.info(f"Photos to update: {len(self.update_list)}, already journaled: {self.skipped_count}")
         if not self.update_list or len(self.update_list) == 0:
             self.logger.info(f"No new or modified photo found.")
             exit(0)
         self.total_photos = len(self.update_list)
         asyncio.run(self.scan_async())
 
+    def ingest(self, producer):
+        """Start scanning while producer(feed) is still discovering photos."""
+        self.update_list = []
+        self.total_photos = 0
+        self._load_journal()
+        asyncio.run(self.scan_async(producer))
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Scan photo for face and bib of an event")
     parser.add_argument("-c", "--cloud-storage-id", type=int, help="Cloud storage ID")
     args = parser.parse_args()
-    try:
-        set_start_method('spawn')
-    except RuntimeError:
-        pass
+    configure_start_method()
     scaner = Scaner(args.cloud_storage_id)
     scaner.scan()
@@ -0,0 +1,156 @@
+import os
+import glob
+import json
+import threading
+import requests
+
+# Record keys that only exist in the log, everything else is the result the API receives
+LOCAL_KEYS = ('photo_id', 'name', 'gdid', 'modified_time', 'face_drops', 'burst_of')
+
+class ResultLog:
+    """Append-only local journal of the photo results a scan worker produced.
+
+    One json line per photo in <dir>/<cloud_storage_id>/worker-<id>-<pid>.jsonl, so
+    workers never share a file. A result is written before it is uploaded, and an
+    {'ack': [photo ids]} line follows once the API stored it, or rejected it for good,
+    so unsent results can be replayed after a crash. The local search index is built
+    from these files too.
+    """
+    def __init__(self, results_dir, cloud_storage_id, worker_id, fsync=False):
+        self.dir = os.path.join(results_dir, str(cloud_storage_id))
+        os.makedirs(self.dir, exist_ok=True)
+        self.path = os.path.join(self.dir, f"worker-{worker_id}-{os.getpid()}.jsonl")
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.file = open(self.path, 'a')
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if self.fsync:
+                os.fsync(self.file.fileno())
+
+    def append(self, p, data):
+        self._write({'photo_id': p['id'], 'name': p['name'], 'gdid': p['gdid'],
+                     'modified_time': p.get('modified_time'), **data})
+
+    def ack(self, photo_ids, rejected=False):
+        """Mark results as done: stored by the API, or rejected by it for good."""
+        record = {'ack': list(photo_ids)}
+        if rejected:
+            record['rejected'] = True
+        self._write(record)
+
+    def close(self):
+        self.file.close()
+
+def result_files(results_dir, cloud_storage_ids):
+    """Result logs of the cloud storages, oldest first so newer scans of a photo win."""
+    files = []
+    for cs_id in cloud_storage_ids:
+        files += glob.glob(os.path.join(results_dir, str(cs_id), '*.jsonl'))
+    return sorted(files, key=os.path.getmtime)
+
+def iter_records(files):
+    """Yields (file, line number, record) for every readable line, torn last lines are skipped."""
+    for path in files:
+        with open(path, 'r') as f:
+            for line_no, line in enumerate(f):
+                try:
+                    yield path, line_no, json.loads(line)
+                except ValueError:
+                    continue
+
+def latest_records(files):
+    """Only the newest record of each photo, the photo may have been scanned more than once."""
+    latest = {}
+    for path, line_no, record in iter_records(files):
+        if 'photo_id' in record:
+            latest[record['photo_id']] = (path, line_no)
+    wanted = set(latest.values())
+    for path, line_no, record in iter_records(files):
+        if (path, line_no) in wanted:
+            yield record
+
+def journal_state(files):
+    """{photo_id: {'pos', 'gdid', 'modified_time', 'acked', 'rejected'}} for the newest record of every photo.
+
+    Only positions are kept, results are read again by pending_records.
+    """
+    state = {}
+    for path, line_no, record in iter_records(files):
+        if 'ack' in record:
+            for photo_id in record['ack']:
+                if photo_id in state:
+                    state[photo_id]['acked'] = True
+                    state[photo_id]['rejected'] = record.get('rejected', False)
+        elif 'photo_id' in record:
+            state[record['photo_id']] = {'pos': (path, line_no), 'gdid': record.get('gdid'),
+                                         'modified_time': record.get('modified_time'), 'acked': False, 'rejected': False}
+    return state
+
+def pending_records(files, state):
+    """Newest records the API never acknowledged."""
+    wanted = {s['pos'] for s in state.values() if not s['acked']}
+    for path, line_no, record in iter_records(files):
+        if (path, line_no) in wanted:
+            yield record
+
+def api_result(record):
+    return {k: v for k, v in record.items() if k not in LOCAL_KEYS}
+
+def _rejected(e):
+    # 4xx other than 429: sending the same result again fails the same way
+    status = e.response.status_code if e.response is not None else None
+    return status is not None and 400 <= status < 500 and status != 429
+
+def _send_batch(client, batch, journal, logger):
+    """Send one batch, returns the photo ids the API rejected. Connection and 5xx errors are raised."""
+    try:
+        client.add_photo_results(batch)
+        journal.ack([photo_id for photo_id, _ in batch])
+        return []
+    except requests.exceptions.HTTPError as e:
+        if not _rejected(e):
+            raise
+        logger.warning(f"Batch of {len(batch)} results rejected ({e}), sending them one by one")
+    rejected = []
+    for photo_id, data in batch:
+        try:
+            client.add_photo_result(photo_id, data)
+            journal.ack([photo_id])
+        except requests.exceptions.HTTPError as e:
+            if not _rejected(e):
+                raise
+            logger.error(f"Result of photo {photo_id} rejected: {e}")
+            rejected.append(photo_id)
+    if rejected:
+        journal.ack(rejected, rejected=True)
+    return rejected
+
+def replay(client, files, state, journal, logger, bulk_size=20):
+    """Send the unacknowledged results in batches, returns (sent, rejected).
+
+    Rejected results are acked as such so they don't block the rest of the journal.
+    Connection and 5xx errors stop the replay, the remaining results wait for the next one.
+    """
+    sent = rejected = 0
+    batch = []
+    def flush():
+        nonlocal sent, rejected
+        failed = _send_batch(client, batch, journal, logger)
+        sent += len(batch) - len(failed)
+        rejected += len(failed)
+        batch.clear()
+    try:
+        for record in pending_records(files, state):
+            batch.append((record['photo_id'], api_result(record)))
+            if len(batch) >= bulk_size:
+                flush()
+        if batch:
+            flush()
+    except Exception as e:
+        logger.error(f"Replay stopped after {sent} results: {str(e)}")
+    return sent, rejected
@@ -0,0 +1,347 @@
+import os
+import json
+import time
+import numpy as np
+from datetime import datetime
+from embedding_codec import decode_embedding
+from scan_results import result_files, latest_records
+from cluster import FaceClusters
+
+# Index layout, one directory per event:
+#   meta.json         dim, count, cloud storages, build time
+#   embeddings.f32    L2-normalized float32 face embeddings, row major (count, dim), memory mapped
+#   photo_ids.npy     photo id of every row
+#   confidences.npy   face detection confidence of every row
+#   bibs.json         bib number -> [[photo_id, confidence], ...]
+#   photos.json       photo id -> {'name', 'gdid'} of every indexed photo
+#   ivf_*.npy, pq_*.npy  optional approximate index, see IVFIndex
+#   cluster_*         optional identity clusters, see cluster.FaceClusters
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return x / norms
+
+def event_index_dir(index_dir, event_id):
+    return os.path.join(index_dir, f"event_{event_id}")
+
+def build_index(index_dir, results_dir, cloud_storage_ids, dim, cluster_threshold=0, cluster_block=4096):
+    """Build the exact index of an event from the local scan result logs.
+
+    With cluster_threshold the faces are clustered into identities while they are written.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    files = result_files(results_dir, cloud_storage_ids)
+    photo_ids, confidences, bibs, photos = [], [], {}, {}
+    clusters = FaceClusters(dim, cluster_threshold) if cluster_threshold else None
+    pending = []
+    # Rows are streamed to disk, only ids and confidences are held in memory
+    with open(os.path.join(index_dir, 'embeddings.f32'), 'wb') as f:
+        for record in latest_records(files):
+            photos[record['photo_id']] = {'name': record.get('name'), 'gdid': record.get('gdid')}
+            for face in record.get('face_photos', []):
+                vec = decode_embedding(face)
+                if len(vec) != dim:
+                    continue
+                vec = normalize(vec)
+                f.write(vec.tobytes())
+                if clusters is not None:
+                    pending.append(vec)
+                    if len(pending) >= cluster_block:
+                        clusters.add(pending)
+                        pending = []
+                photo_ids.append(record['photo_id'])
+                confidences.append(face.get('confidence', 0.0))
+            for b in record.get('bib_photos', []):
+                bibs.setdefault(str(b['bib_number']), []).append([record['photo_id'], b['confidence']])
+    np.save(os.path.join(index_dir, 'photo_ids.npy'), np.asarray(photo_ids, dtype=np.int64))
+    np.save(os.path.join(index_dir, 'confidences.npy'), np.asarray(confidences, dtype=np.float32))
+    with open(os.path.join(index_dir, 'bibs.json'), 'w') as f:
+        json.dump(bibs, f)
+    with open(os.path.join(index_dir, 'photos.json'), 'w') as f:
+        json.dump(photos, f)
+    IVFIndex.remove(index_dir)
+    FaceClusters.remove(index_dir)
+    if clusters is not None:
+        if pending:
+            clusters.add(pending)
+        clusters.save(index_dir)
+    meta = {
+        'dim': dim,
+        'count': len(photo_ids),
+        'photos': len(photos),
+        'clusters': len(clusters) if clusters is not None else 0,
+        'bibs': len(bibs),
+        'cloud_storage_ids': list(cloud_storage_ids),
+        'built_at': datetime.now().isoformat()
+    }
+    with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+def kmeans(x, k, iters=10, seed=0, block_rows=65536):
+    """Plain L2 k-means, good enough to train coarse lists and PQ codebooks on a sample."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    k = min(k, len(x))
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iters):
+        assign = assign_nearest(x, centroids, block_rows)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        counts = np.bincount(assign, minlength=k)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # Re-seed empty clusters from random points
+        if empty.any():
+            centroids[empty] = x[rng.choice(len(x), int(empty.sum()), replace=False)]
+    return centroids
+
+def assign_nearest(x, centroids, block_rows=65536):
+    c_norms = (centroids ** 2).sum(axis=1)
+    assign = np.empty(len(x), dtype=np.int64)
+    for start in range(0, len(x), block_rows):
+        block = np.asarray(x[start:start + block_rows], dtype=np.float32)
+        assign[start:start + len(block)] = np.argmin(c_norms[None, :] - 2 * block @ centroids.T, axis=1)
+    return assign
+
+class IVFIndex:
+    """Inverted file index over the embedding rows with optional product quantization.
+
+    Rows are grouped by their nearest coarse centroid. A query scans only the nprobe
+    closest lists; with PQ the candidates are scored from uint8 codes (m bytes per row)
+    and the best ones re-ranked exactly from the memory mapped embeddings.
+    """
+    FILES = ('ivf_centroids.npy', 'ivf_order.npy', 'ivf_offsets.npy', 'pq_codebooks.npy', 'pq_codes.npy')
+
+    def __init__(self, centroids, order, offsets, codebooks=None, codes=None):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.codebooks = codebooks
+        self.codes = codes
+
+    @classmethod
+    def build(cls, embeddings, nlist, pq_m=0, sample=100000, iters=10, seed=0):
+        rng = np.random.default_rng(seed)
+        count, dim = embeddings.shape
+        train = np.asarray(embeddings[np.sort(rng.choice(count, min(sample, count), replace=False))])
+        centroids = normalize(kmeans(train, nlist, iters, seed))
+        lists = assign_nearest(embeddings, centroids)
+        order = np.argsort(lists, kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=len(centroids)))])
+        codebooks = codes = None
+        if pq_m:
+            if dim % pq_m:
+                raise ValueError(f"pq_m {pq_m} must divide the embedding dimension {dim}")
+            sub = dim // pq_m
+            codebooks = np.stack([kmeans(train[:, j * sub:(j + 1) * sub], 256, iters, seed) for j in range(pq_m)])
+            codes = np.empty((count, pq_m), dtype=np.uint8)
+            for j in range(pq_m):
+                codes[:, j] = assign_nearest(embeddings[:, j * sub:(j + 1) * sub], codebooks[j])
+        return cls(centroids, order, offsets, codebooks, codes)
+
+    def save(self, index_dir):
+        np.save(os.path.join(index_dir, 'ivf_centroids.npy'), self.centroids)
+        np.save(os.path.join(index_dir, 'ivf_order.npy'), self.order)
+        np.save(os.path.join(index_dir, 'ivf_offsets.npy'), self.offsets)
+        if self.codes is not None:
+            np.save(os.path.join(index_dir, 'pq_codebooks.npy'), self.codebooks)
+            np.save(os.path.join(index_dir, 'pq_codes.npy'), self.codes)
+
+    @classmethod
+    def load(cls, index_dir):
+        if not os.path.exists(os.path.join(index_dir, 'ivf_centroids.npy')):
+            return None
+        arrays = [np.load(os.path.join(index_dir, name), mmap_mode='r') if os.path.exists(os.path.join(index_dir, name)) else None
+                  for name in cls.FILES]
+        return cls(*arrays)
+
+    @classmethod
+    def remove(cls, index_dir):
+        for name in cls.FILES:
+            path = os.path.join(index_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def candidates(self, queries, nprobe):
+        lists = np.unique(np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe])
+        return np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+
+    def pq_scores(self, queries, rows):
+        m, _, sub = self.codebooks.shape
+        codes = np.asarray(self.codes[rows])
+        scores = np.full(len(rows), -np.inf, dtype=np.float32)
+        for q in queries:
+            # Inner products split over the sub spaces, one 256 entry table per sub space
+            tables = np.einsum('mkd,md->mk', self.codebooks, q.reshape(m, sub))
+            scores = np.maximum(scores, tables[np.arange(m), codes].sum(axis=1))
+        return scores
+
+class SearchIndex:
+    def __init__(self, index_dir, block_rows=262144):
+        self.index_dir = index_dir
+        self.block_rows = block_rows
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.count = self.meta['count']
+        if self.count:
+            self.embeddings = np.memmap(os.path.join(index_dir, 'embeddings.f32'), dtype=np.float32, mode='r',
+                                        shape=(self.count, self.dim))
+        else:
+            self.embeddings = np.zeros((0, self.dim), dtype=np.float32)
+        self.photo_ids = np.load(os.path.join(index_dir, 'photo_ids.npy'), mmap_mode='r')
+        self.confidences = np.load(os.path.join(index_dir, 'confidences.npy'), mmap_mode='r')
+        self.ivf = IVFIndex.load(index_dir)
+        self.clusters = FaceClusters.load(index_dir, self.dim)
+        self._bibs = None
+        self._photos = None
+
+    @property
+    def bibs(self):
+        if self._bibs is None:
+            with open(os.path.join(self.index_dir, 'bibs.json'), 'r') as f:
+                self._bibs = json.load(f)
+        return self._bibs
+
+    @property
+    def photos(self):
+        if self._photos is None:
+            path = os.path.join(self.index_dir, 'photos.json')
+            self._photos = {}
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    self._photos = {int(photo_id): photo for photo_id, photo in json.load(f).items()}
+        return self._photos
+
+    def build_ivf(self, nlist=0, pq_m=0, sample=100000):
+        nlist = nlist or max(int(4 * np.sqrt(self.count)), 1)
+        self.ivf = IVFIndex.build(self.embeddings, nlist, pq_m, sample)
+        self.ivf.save(self.index_dir)
+        return self.ivf
+
+    def update_clusters(self, threshold=0.7, block_rows=65536):
+        """Cluster the rows not clustered yet, or everything again for another threshold."""
+        if self.clusters is None or self.clusters.threshold != threshold or self.clusters.rows > self.count:
+            self.clusters = FaceClusters(self.dim, threshold)
+        for start in range(self.clusters.rows, self.count, block_rows):
+            self.clusters.add(self.embeddings[start:start + block_rows])
+        self.clusters.save(self.index_dir)
+        return self.clusters
+
+    def _exact_rows(self, queries, k):
+        """Best k rows by cosine similarity, the max over all query faces."""
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, self.count, self.block_rows):
+            scores = (self.embeddings[start:start + self.block_rows] @ queries.T).max(axis=1)
+            rows = np.arange(start, start + len(scores))
+            if len(scores) > k:
+                top = np.argpartition(-scores, k)[:k]
+                rows, scores = rows[top], scores[top]
+            best_rows = np.concatenate([best_rows, rows])
+            best_scores = np.concatenate([best_scores, scores])
+            if len(best_rows) > k:
+                top = np.argpartition(-best_scores, k)[:k]
+                best_rows, best_scores = best_rows[top], best_scores[top]
+        return best_rows, best_scores
+
+    def _ivf_rows(self, queries, k, nprobe, rerank=4):
+        rows = self.ivf.candidates(queries, nprobe)
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        if self.ivf.codes is not None:
+            approx = self.ivf.pq_scores(queries, rows)
+            keep = min(len(rows), k * rerank)
+            rows = rows[np.argpartition(-approx, keep - 1)[:keep]]
+        rows = np.sort(rows)
+        scores = (np.asarray(self.embeddings[rows]) @ queries.T).max(axis=1)
+        if len(rows) > k:
+            top = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[top], scores[top]
+        return rows, scores
+
+    def _cluster_rows(self, queries, k, cluster_probe):
+        # Best clusters by centroid, then the members of those clusters scored exactly
+        scores = (queries @ self.clusters.centroids.T).max(axis=0)
+        probe = min(cluster_probe, len(scores))
+        rows = np.sort(self.clusters.members(np.argpartition(-scores, probe - 1)[:probe]))
+        if len(rows) == 0:
+            return rows, np.empty(0, dtype=np.float32)
+        scores = (np.asarray(self.embeddings[rows]) @ queries.T).max(axis=1)
+        if len(rows) > k:
+            top = np.argpartition(-scores, k)[:k]
+            rows, scores = rows[top], scores[top]
+        return rows, scores
+
+    def search(self, queries, k=20, min_score=0.0, use_ivf=True, nprobe=8, use_clusters=True, cluster_probe=32):
+        """Top k photos for one or more query embeddings as [(photo_id, score, face confidence)].
+
+        Uses the identity clusters when built, else the IVF index when built, else exact search.
+        """
+        if self.count == 0:
+            return []
+        queries = normalize(np.atleast_2d(queries))
+        # A runner appears in a photo at most once, so fetch extra rows before folding them into photos
+        rows_k = min(self.count, k * 4)
+        if use_clusters and self.clusters is not None and len(self.clusters) and self.clusters.rows == self.count:
+            rows, scores = self._cluster_rows(queries, rows_k, cluster_probe)
+        elif use_ivf and self.ivf is not None:
+            rows, scores = self._ivf_rows(queries, rows_k, nprobe)
+        else:
+            rows, scores = self._exact_rows(queries, rows_k)
+        order = np.argsort(-scores)
+        best = {}
+        for row, score in zip(rows[order], scores[order]):
+            if score < min_score:
+                break
+            photo_id = int(self.photo_ids[row])
+            if photo_id not in best:
+                best[photo_id] = (photo_id, float(score), float(self.confidences[row]))
+                if len(best) >= k:
+                    break
+        return list(best.values())
+
+    def search_bib(self, bib_number):
+        hits = self.bibs.get(str(bib_number), [])
+        best = {}
+        for photo_id, confidence in hits:
+            best[photo_id] = max(confidence, best.get(photo_id, 0.0))
+        return sorted(best.items(), key=lambda item: -item[1])
+
+def benchmark(index, queries=100, k=20, nprobe=8, noise=0.05, seed=0, cluster_probe=32):
+    """Latency of exact, IVF and cluster search, and their recall@k against exact, on perturbed index rows."""
+    rng = np.random.default_rng(seed)
+    if index.count == 0:
+        return {}
+    rows = rng.choice(index.count, min(queries, index.count), replace=False)
+    probes = normalize(np.asarray(index.embeddings[np.sort(rows)]) + rng.normal(scale=noise, size=(len(rows), index.dim)))
+    report = {'faces': index.count, 'queries': len(probes), 'k': k}
+    exact_results = []
+    timings = []
+    for q in probes:
+        start = time.perf_counter()
+        exact_results.append({photo_id for photo_id, _, _ in index.search(q, k, -1.0, use_ivf=False, use_clusters=False)})
+        timings.append((time.perf_counter() - start) * 1000)
+    report['exact_ms_p50'] = float(np.percentile(timings, 50))
+    report['exact_ms_p95'] = float(np.percentile(timings, 95))
+    modes = []
+    if index.ivf is not None:
+        modes.append(('ivf', {'use_ivf': True, 'use_clusters': False, 'nprobe': nprobe}))
+    if index.clusters is not None:
+        report['clusters'] = len(index.clusters)
+        modes.append(('cluster', {'use_ivf': False, 'use_clusters': True, 'cluster_probe': cluster_probe}))
+    for name, options in modes:
+        timings = []
+        recalls = []
+        for q, exact in zip(probes, exact_results):
+            start = time.perf_counter()
+            found = {photo_id for photo_id, _, _ in index.search(q, k, -1.0, **options)}
+            timings.append((time.perf_counter() - start) * 1000)
+            recalls.append(len(found & exact) / max(len(exact), 1))
+        report[f'{name}_ms_p50'] = float(np.percentile(timings, 50))
+        report[f'{name}_ms_p95'] = float(np.percentile(timings, 95))
+        report[f'{name}_recall'] = float(np.mean(recalls))
+    return report
@@ -0,0 +1,36 @@
+import numpy as np
+from burst import BurstTracker, group_bursts, name_sequence
+
+def photo(photo_id, name, created_time):
+    return {'id': photo_id, 'name': name, 'created_time': created_time}
+
+def test_name_sequence():
+    assert name_sequence('folder/IMG_0123.JPG') == ('IMG_', 123)
+    assert name_sequence('finish.jpg') == ('finish', None)
+
+def test_group_bursts():
+    photos = [
+        photo(3, 'IMG_0012.jpg', '2024-05-01T08:00:01Z'),
+        photo(1, 'IMG_0010.jpg', '2024-05-01T08:00:00Z'),
+        photo(2, 'IMG_0011.jpg', '2024-05-01T08:00:00.500Z'),
+        photo(4, 'IMG_0013.jpg', '2024-05-01T08:00:30Z'),
+        photo(5, 'DSC_0014.jpg', '2024-05-01T08:00:30.2Z'),
+    ]
+    groups = [[p['id'] for p in g] for g in group_bursts(photos, max_gap=2.0, max_step=2)]
+    assert groups == [[1, 2, 3], [4], [5]]
+    groups = [[p['id'] for p in g] for g in group_bursts(photos, max_size=2)]
+    assert groups == [[1, 2], [3], [4], [5]]
+
+def test_tracker_reuses_near_duplicates():
+    rng = np.random.default_rng(0)
+    frame = (rng.random((120, 160, 3)) * 255).astype(np.uint8)
+    tracker = BurstTracker(max_distance=6, max_diff=8.0, verify_every=0)
+    signature = tracker.signature(frame)
+    assert tracker.match(1, signature) is None
+    tracker.represent(1, signature, {'face_photos': [], 'bib_photos': []})
+    shifted = np.clip(frame.astype(np.int16) + 2, 0, 255).astype(np.uint8)
+    assert tracker.match(1, tracker.signature(shifted))[0] == 1
+    other = (rng.random((120, 160, 3)) * 255).astype(np.uint8)
+    assert tracker.match(1, tracker.signature(other)) is None
+    # A new burst never reuses the previous one
+    assert tracker.match(2, signature) is None
@@ -0,0 +1,34 @@
+import io
+import cv2
+import numpy as np
+from PIL import Image
+from scan import EXIF_ORIENTATION, decode_image, reduced_decode_flag
+
+def jpeg(width, height, orientation=1):
+    """A JPEG whose left half is red, tagged with an EXIF orientation."""
+    pixels = np.zeros((height, width, 3), dtype=np.uint8)
+    pixels[:, :width // 2] = (255, 0, 0)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = orientation
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, 'JPEG', quality=95, exif=exif.tobytes())
+    return buf.getvalue()
+
+def test_exif_orientation_applied():
+    img = decode_image(jpeg(80, 40, orientation=6), 'rotated.jpg')
+    # Orientation 6 is shown turned 90 degrees clockwise: portrait, the red half on top
+    assert img.shape == (80, 40, 3)
+    assert img[10, 20, 2] > 200 and img[10, 20, 0] < 50
+    assert img[70, 20, 2] < 50
+
+def test_reduced_decode_and_width():
+    assert reduced_decode_flag(8000, 1000) == cv2.IMREAD_REDUCED_COLOR_8
+    assert reduced_decode_flag(7999, 1000) == cv2.IMREAD_REDUCED_COLOR_4
+    assert reduced_decode_flag(3000, 1000) == cv2.IMREAD_REDUCED_COLOR_2
+    assert reduced_decode_flag(1999, 1000) == cv2.IMREAD_COLOR
+    assert reduced_decode_flag(8000, None) == cv2.IMREAD_COLOR
+    img = decode_image(jpeg(1600, 800), 'wide.jpg', max_width=400)
+    assert img.shape == (200, 400, 3)
+    # A portrait frame is reduced by its displayed width, not the stored one
+    img = decode_image(jpeg(1600, 800, orientation=8), 'tall.jpg', max_width=400)
+    assert img.shape == (800, 400, 3)
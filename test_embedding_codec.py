@@ -0,0 +1,34 @@
+import json
+import numpy as np
+import pytest
+from embedding_codec import encode_embedding, decode_embedding
+
+def _vector(dim=512, seed=0):
+    return np.random.default_rng(seed).normal(size=dim).astype(np.float32) * 3
+
+def test_json_is_compatible():
+    vec = _vector()
+    face = encode_embedding(vec, 'json')
+    assert list(face) == ['embedding']
+    assert np.allclose(decode_embedding(face), vec)
+
+@pytest.mark.parametrize('fmt,tolerance', [('float16', 1e-3), ('int8', 1e-2)])
+def test_compact_roundtrip(fmt, tolerance):
+    vec = _vector()
+    face = encode_embedding(vec, fmt, dim=512)
+    assert face['embedding_dtype'] == fmt
+    assert face['embedding_dim'] == 512
+    decoded = decode_embedding(json.loads(json.dumps(face)))
+    normalized = vec / np.linalg.norm(vec)
+    assert np.abs(decoded - normalized).max() < tolerance
+    assert float(decoded @ normalized) > 0.999
+
+def test_compact_is_smaller():
+    vec = _vector()
+    json_size = len(json.dumps(encode_embedding(vec, 'json')))
+    assert len(json.dumps(encode_embedding(vec, 'float16'))) * 5 < json_size
+    assert len(json.dumps(encode_embedding(vec, 'int8'))) * 8 < json_size
+
+def test_dimension_mismatch():
+    with pytest.raises(ValueError):
+        encode_embedding(_vector(128), 'float16', dim=512)
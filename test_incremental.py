@@ -0,0 +1,146 @@
+import re
+import pytest
+from googleapiclient.errors import HttpError
+from gdrive import GoogleDrive, FOLDER_MIME_TYPE
+from incremental import CursorInvalid, CursorStore, apply_delta, drive_cursor, drive_delta
+
+class _Request:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return self.fn()
+
+class _Resp(dict):
+    def __init__(self, status):
+        super().__init__(status=str(status))
+        self.status = status
+        self.reason = 'fake'
+
+class FakeDriveService:
+    """Just enough of the Drive v3 files/changes API for GoogleDrive, two files per page."""
+    def __init__(self):
+        self.files_by_id = {}
+        self.change_log = []
+
+    def add(self, gdid, name, parent, folder=False, size=1, modified='2025-01-01T00:00:00Z'):
+        f = {'id': gdid, 'name': name, 'parents': [parent], 'size': str(size), 'trashed': False,
+             'mimeType': FOLDER_MIME_TYPE if folder else 'image/jpeg',
+             'createdTime': '2025-01-01T00:00:00Z', 'modifiedTime': modified}
+        self.files_by_id[gdid] = f
+        self.change_log.append({'fileId': gdid, 'removed': False, 'file': dict(f)})
+
+    def modify(self, gdid, **fields):
+        self.files_by_id[gdid].update(fields)
+        self.change_log.append({'fileId': gdid, 'removed': False, 'file': dict(self.files_by_id[gdid])})
+
+    def remove(self, gdid):
+        del self.files_by_id[gdid]
+        self.change_log.append({'fileId': gdid, 'removed': True})
+
+    def files(self):
+        return self
+
+    def changes(self):
+        return _Changes(self)
+
+    def list(self, q, pageToken=None, **kwargs):
+        parent = re.match(r"'([^']+)' in parents", q).group(1)
+        children = [f for f in self.files_by_id.values() if parent in f['parents'] and not f['trashed']]
+        start = int(pageToken or 0)
+        response = {'files': children[start:start + 2]}
+        if start + 2 < len(children):
+            response['nextPageToken'] = str(start + 2)
+        return _Request(lambda: response)
+
+class _Changes:
+    def __init__(self, drive):
+        self.drive = drive
+
+    def getStartPageToken(self):
+        return _Request(lambda: {'startPageToken': str(len(self.drive.change_log))})
+
+    def list(self, pageToken, **kwargs):
+        if not pageToken.isdigit() or int(pageToken) > len(self.drive.change_log):
+            def fail():
+                raise HttpError(_Resp(400), b'Invalid Value')
+            return _Request(fail)
+        start = int(pageToken)
+        changes = self.drive.change_log[start:start + 2]
+        response = {'changes': changes}
+        if start + 2 < len(self.drive.change_log):
+            response['nextPageToken'] = str(start + 2)
+        else:
+            response['newStartPageToken'] = str(len(self.drive.change_log))
+        return _Request(lambda: response)
+
+@pytest.fixture
+def drive():
+    service = FakeDriveService()
+    service.add('root', 'root', 'none', folder=True)
+    service.add('km5', 'km5', 'root', folder=True)
+    for i in range(3):
+        service.add(f'a{i}', f'a{i}.jpg', 'root')
+        service.add(f'b{i}', f'b{i}.jpg', 'km5')
+    service.add('notes', 'notes.txt', 'root')
+    return service
+
+def _full(drive):
+    gdrive = GoogleDrive(service=drive, list_threads=4)
+    token = gdrive.get_start_page_token()
+    folders = set()
+    photos = gdrive._scan_folder('root', recursive=True, folders=folders)
+    return gdrive, photos, drive_cursor(token, 'root', True, folders)
+
+def test_concurrent_listing_keeps_shape(drive):
+    _, photos, cursor = _full(drive)
+    assert sorted(p['gdid'] for p in photos) == ['a0', 'a1', 'a2', 'b0', 'b1', 'b2']
+    assert set(photos[0]) == {'gdid', 'name', 'size', 'created_time', 'modified_time', 'base_url'}
+    assert cursor['folders'] == ['km5', 'root']
+
+def test_delta(drive):
+    gdrive, photos, cursor = _full(drive)
+    drive.add('a3', 'a3.jpg', 'root')
+    drive.modify('b0', size='5', modifiedTime='2025-02-01T00:00:00Z')
+    drive.remove('a1')
+    drive.add('elsewhere', 'x.jpg', 'other_folder')
+    upserts, removed, next_cursor = drive_delta(gdrive, cursor, 'root', True)
+    assert set(upserts) == {'a3', 'b0'}
+    assert removed == {'a1', 'elsewhere'}
+    dblist = [dict(p, id=n) for n, p in enumerate(photos)]
+    only_new, changed, missing = apply_delta(upserts, removed, dblist)
+    assert [p['gdid'] for p in only_new] == ['a3']
+    assert [p['gdid'] for p in changed] == ['b0']
+    assert [p['gdid'] for p in missing] == ['a1']
+    upserts, removed, _ = drive_delta(gdrive, next_cursor, 'root', True)
+    assert not upserts and not removed
+
+def test_new_folder_needs_full_refresh(drive):
+    gdrive, _, cursor = _full(drive)
+    drive.add('km10', 'km10', 'root', folder=True)
+    with pytest.raises(CursorInvalid):
+        drive_delta(gdrive, cursor, 'root', True)
+
+def test_deleted_folder_needs_full_refresh(drive):
+    gdrive, _, cursor = _full(drive)
+    # A permanent delete carries no file, the change can't tell it was a folder
+    drive.remove('km5')
+    with pytest.raises(CursorInvalid):
+        drive_delta(gdrive, cursor, 'root', True)
+
+def test_invalid_token(drive):
+    gdrive, _, cursor = _full(drive)
+    with pytest.raises(CursorInvalid):
+        drive_delta(gdrive, dict(cursor, token='expired'), 'root', True)
+    with pytest.raises(CursorInvalid):
+        drive_delta(gdrive, cursor, 'another_root', True)
+
+def test_cursor_store(tmp_path):
+    store = CursorStore(str(tmp_path / 'state' / 'cursors.json'))
+    assert store.get(1) is None
+    store.set(1, drive_cursor('7', 'root', True, {'root'}))
+    store.set(2, drive_cursor('3', 'km5', False, {'km5'}))
+    assert store.get(1)['token'] == '7'
+    store.set(1, None)
+    assert store.get(1) is None
+    assert store.get(2) == {'type': 'drive', 'token': '3', 'folder_id': 'km5', 'recursive': False, 'folders': ['km5']}
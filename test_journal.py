@@ -0,0 +1,92 @@
+import logging
+import requests
+from scan_results import ResultLog, api_result, journal_state, latest_records, pending_records, replay, result_files
+
+def photo(photo_id, modified_time='2024-05-01T08:00:00Z'):
+    return {'id': photo_id, 'name': f"{photo_id}.jpg", 'gdid': f"g{photo_id}", 'modified_time': modified_time}
+
+def test_acked_results_are_not_pending(tmp_path):
+    log = ResultLog(str(tmp_path), 7, 0)
+    for photo_id in (1, 2, 3):
+        log.append(photo(photo_id), {'face_photos': [], 'bib_photos': [], 'photo_size': photo_id, 'face_drops': {}})
+    log.ack([1, 3])
+    log.close()
+    files = result_files(str(tmp_path), [7])
+    state = journal_state(files)
+    assert {photo_id: entry['acked'] for photo_id, entry in state.items()} == {1: True, 2: False, 3: True}
+    pending = list(pending_records(files, state))
+    assert [r['photo_id'] for r in pending] == [2]
+    assert api_result(pending[0]) == {'face_photos': [], 'bib_photos': [], 'photo_size': 2}
+    # Ack lines are not results
+    assert sorted(r['photo_id'] for r in latest_records(files)) == [1, 2, 3]
+
+def test_rescan_after_ack_is_pending_again(tmp_path):
+    log = ResultLog(str(tmp_path), 7, 0)
+    log.append(photo(1), {'photo_size': 1})
+    log.ack([1])
+    log.append(photo(1, '2024-05-02T08:00:00Z'), {'photo_size': 2})
+    log.close()
+    files = result_files(str(tmp_path), [7])
+    state = journal_state(files)
+    assert state[1]['acked'] is False
+    assert state[1]['modified_time'] == '2024-05-02T08:00:00Z'
+    assert [r['photo_size'] for r in pending_records(files, state)] == [2]
+
+def test_torn_last_line_is_ignored(tmp_path):
+    log = ResultLog(str(tmp_path), 7, 0)
+    log.append(photo(1), {'photo_size': 1})
+    log.close()
+    with open(log.path, 'a') as f:
+        f.write('{"photo_id": 2, "name"')
+    state = journal_state(result_files(str(tmp_path), [7]))
+    assert list(state) == [1]
+
+class FakeClient:
+    """Rejects the results of some photos with a 4xx, fails with a 503 once down is set."""
+    def __init__(self, rejected=(), down=False):
+        self.rejected = set(rejected)
+        self.down = down
+        self.stored = []
+
+    def _fail(self, status):
+        response = requests.Response()
+        response.status_code = status
+        raise requests.exceptions.HTTPError(f"{status} error", response=response)
+
+    def add_photo_results(self, results):
+        if self.down:
+            self._fail(503)
+        if any(photo_id in self.rejected for photo_id, _ in results):
+            self._fail(400)
+        self.stored += [photo_id for photo_id, _ in results]
+
+    def add_photo_result(self, photo_id, data):
+        if photo_id in self.rejected:
+            self._fail(404)
+        self.stored.append(photo_id)
+
+def journal_with(tmp_path, count):
+    log = ResultLog(str(tmp_path), 7, 0)
+    for photo_id in range(1, count + 1):
+        log.append(photo(photo_id), {'photo_size': photo_id})
+    log.close()
+    return result_files(str(tmp_path), [7])
+
+def test_replay_acks_rejected_results(tmp_path):
+    files = journal_with(tmp_path, 5)
+    client = FakeClient(rejected={2})
+    journal = ResultLog(str(tmp_path), 7, 'sync')
+    assert replay(client, files, journal_state(files), journal, logging.getLogger(), bulk_size=2) == (4, 1)
+    journal.close()
+    assert client.stored == [1, 3, 4, 5]
+    state = journal_state(result_files(str(tmp_path), [7]))
+    assert all(entry['acked'] for entry in state.values())
+    assert [photo_id for photo_id, entry in state.items() if entry['rejected']] == [2]
+
+def test_replay_stops_on_server_error(tmp_path):
+    files = journal_with(tmp_path, 3)
+    journal = ResultLog(str(tmp_path), 7, 'sync')
+    assert replay(FakeClient(down=True), files, journal_state(files), journal, logging.getLogger()) == (0, 0)
+    journal.close()
+    state = journal_state(result_files(str(tmp_path), [7]))
+    assert not any(entry['acked'] for entry in state.values())
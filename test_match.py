@@ -0,0 +1,50 @@
+import json
+import logging
+import os
+import numpy as np
+from match import fold_hits, match_faces, write_manifests
+from search import normalize
+
+class FakeIndex:
+    def __init__(self, embeddings, photo_ids, bibs=None):
+        self.embeddings = embeddings
+        self.photo_ids = photo_ids
+        self.count = len(embeddings)
+        self.bibs = bibs or {}
+        self.photos = {}
+
+    def search_bib(self, bib):
+        return self.bibs.get(bib, [])
+
+def test_fold_hits_best_per_photo():
+    refs = np.array([1, 0, 0, 0, 1])
+    photos = np.array([5, 7, 7, 8, 5])
+    scores = np.array([0.7, 0.8, 0.9, 0.6, 0.75], dtype=np.float32)
+    r, p, s = fold_hits(refs, photos, scores, max_photos=10)
+    assert list(zip(r, p)) == [(0, 7), (0, 8), (1, 5)]
+    assert np.allclose(s, [0.9, 0.6, 0.75])
+    r, p, _ = fold_hits(refs, photos, scores, max_photos=1)
+    assert list(zip(r, p)) == [(0, 7), (1, 5)]
+
+def test_blocked_match_equals_full():
+    rng = np.random.default_rng(0)
+    faces = normalize(rng.normal(size=(1000, 16)))
+    photo_ids = np.arange(1000) // 3
+    refs = normalize(faces[rng.choice(1000, 40, replace=False)] + rng.normal(scale=0.05, size=(40, 16)))
+    index = FakeIndex(faces, photo_ids)
+    small = match_faces(index, refs, 0.5, 5, block_rows=64, ref_block=7, compact_hits=10)
+    full = match_faces(index, refs, 0.5, 5, block_rows=1000, ref_block=40)
+    for a, b in zip(small, full):
+        assert np.allclose(a, b)
+    assert set(small[0]) == set(range(40))
+
+def test_manifest_names_stay_unique_and_inside(tmp_path):
+    index = FakeIndex(np.zeros((0, 16)), np.zeros(0, dtype=np.int64), bibs={'101': [(3, 0.9)]})
+    roster = [{'bib': '101'}, {'bib': '101'}, {'bib': '../x/1'}, {'bib': ''}]
+    no_hits = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32))
+    output_dir = tmp_path / 'out'
+    summary = write_manifests(index, roster, np.zeros(4, dtype=bool), no_hits, str(output_dir), logging.getLogger())
+    assert [row['manifest'] for row in summary] == ['101.json', '101-row-2.json', '.._x_1.json', 'row-4.json']
+    assert sorted(os.listdir(output_dir)) == ['.._x_1.json', '101-row-2.json', '101.json', 'row-4.json', 'summary.csv']
+    with open(output_dir / '101-row-2.json') as f:
+        assert [p['photo_id'] for p in json.load(f)['photos']] == [3]
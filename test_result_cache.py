@@ -0,0 +1,42 @@
+import copy
+import os
+from config import config
+from result_cache import ResultCache, bytes_hash, model_fingerprint
+
+RESULT = {'face_photos': [{'embedding': [0.1, 0.2], 'confidence': 0.9}], 'bib_photos': [], 'photo_size': 100}
+
+def test_hit_and_miss_on_content(tmp_path):
+    cache = ResultCache(str(tmp_path), 1 << 20, 'fp')
+    key = bytes_hash(b'photo-1')
+    assert cache.get(key) is None
+    cache.put(key, RESULT)
+    assert cache.get(key) == RESULT
+    assert cache.get(bytes_hash(b'photo-2')) is None
+    # Another worker sharing the directory sees the entry
+    assert ResultCache(str(tmp_path), 1 << 20, 'fp').get(key) == RESULT
+
+def test_fingerprint_change_misses(tmp_path):
+    settings = copy.deepcopy(config)
+    fingerprint = model_fingerprint(settings)
+    key = bytes_hash(b'photo-1')
+    ResultCache(str(tmp_path), 1 << 20, fingerprint).put(key, RESULT)
+    settings['ocr']['confidence'] = settings['ocr']['confidence'] + 0.05
+    changed = model_fingerprint(settings)
+    assert changed != fingerprint
+    assert ResultCache(str(tmp_path), 1 << 20, changed).get(key) is None
+    assert ResultCache(str(tmp_path), 1 << 20, fingerprint).get(key) == RESULT
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ResultCache(str(tmp_path), 1 << 20, 'fp')
+    keys = [bytes_hash(f"photo-{i}".encode()) for i in range(4)]
+    for key in keys[:3]:
+        cache.put(key, RESULT)
+    for age, key in enumerate(keys[:3]):
+        os.utime(cache._path(key), (1000 + age, 1000 + age))
+    # Reading the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) == RESULT
+    entry_size = os.path.getsize(cache._path(keys[0]))
+    cache = ResultCache(str(tmp_path), int(entry_size * 3.5), 'fp')
+    cache.put(keys[3], RESULT)
+    assert [cache.get(key) is not None for key in keys] == [True, False, True, True]
+    assert cache.size <= entry_size * 3.5 * 0.9
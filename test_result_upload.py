@@ -0,0 +1,91 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+from config import config
+from client_api import ClientAPI, ResultBuffer
+
+class FakeAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server = self.server
+        server.requests.append((self.path, body, self.client_address))
+        status = 200
+        if server.fail_first and len(server.requests) == 1:
+            status = 503
+        elif self.path.endswith('/photos/results/') and not server.bulk:
+            status = 404
+        payload = json.dumps({'ok': status == 200}).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeAPIHandler)
+    server.requests = []
+    server.bulk = True
+    server.fail_first = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setitem(config, 'api', {**config['api'], 'api_url': f"http://127.0.0.1:{server.server_port}/api/", 'backoff': 0})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def test_bulk_results_single_request(fake_api):
+    client = ClientAPI()
+    client.add_photo_results([(1, {'face_photos': []}), (2, {'face_photos': []})])
+    assert len(fake_api.requests) == 1
+    path, body, _ = fake_api.requests[0]
+    assert path == '/api/photos/results/'
+    assert [r['photo_id'] for r in body] == [1, 2]
+
+def test_bulk_results_fallback(fake_api):
+    fake_api.bulk = False
+    client = ClientAPI()
+    client.add_photo_results([(1, {}), (2, {})])
+    client.add_photo_results([(3, {})])
+    paths = [path for path, _, _ in fake_api.requests]
+    assert paths == ['/api/photos/results/', '/api/photo/1/result/', '/api/photo/2/result/', '/api/photo/3/result/']
+
+def test_session_keeps_connection(fake_api):
+    client = ClientAPI()
+    for photo_id in range(3):
+        client.add_photo_result(photo_id, {})
+    assert len({address for _, _, address in fake_api.requests}) == 1
+
+def test_retry_on_server_error(fake_api):
+    fake_api.fail_first = True
+    assert ClientAPI().add_photo_result(1, {}) == {'ok': True}
+    assert len(fake_api.requests) == 2
+
+def test_add_photos_not_resent(fake_api):
+    fake_api.fail_first = True
+    with pytest.raises(requests.exceptions.HTTPError):
+        ClientAPI().add_photos(7, [{'gdid': 'a'}])
+    assert len(fake_api.requests) == 1
+
+def test_buffer_flush_by_count(fake_api):
+    buffer = ResultBuffer(ClientAPI(), max_count=2, max_wait=60)
+    buffer.add(1, {})
+    assert not buffer.is_due()
+    buffer.add(2, {})
+    assert buffer.is_due()
+    assert [photo_id for photo_id, _ in buffer.flush()] == [1, 2]
+    assert len(buffer) == 0
+    assert len(fake_api.requests) == 1
+
+def test_buffer_flush_by_age(fake_api):
+    buffer = ResultBuffer(ClientAPI(), max_count=10, max_wait=0)
+    assert buffer.time_left() is None
+    buffer.add(1, {})
+    assert buffer.is_due()
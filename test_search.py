@@ -0,0 +1,62 @@
+import numpy as np
+from embedding_codec import encode_embedding
+from scan_results import ResultLog
+from search import SearchIndex, benchmark, build_index, normalize
+
+DIM = 32
+
+def write_results(results_dir, vectors):
+    log = ResultLog(str(results_dir), 7, 0)
+    for photo_id, vec in enumerate(vectors):
+        data = {
+            'face_photos': [{**encode_embedding(vec, 'float16', DIM), 'confidence': 0.9}],
+            'bib_photos': [{'bib_number': str(1000 + photo_id % 10), 'confidence': 0.8}]
+        }
+        log.append({'id': photo_id, 'name': f"{photo_id}.jpg", 'gdid': str(photo_id)}, data)
+    log.close()
+
+def make_index(tmp_path, count=500):
+    vectors = normalize(np.random.default_rng(1).normal(size=(count, DIM)))
+    write_results(tmp_path / 'results', vectors)
+    meta = build_index(str(tmp_path / 'index'), str(tmp_path / 'results'), [7], DIM)
+    assert meta['count'] == count and meta['photos'] == count
+    return vectors, SearchIndex(str(tmp_path / 'index'), block_rows=64)
+
+def test_exact_search(tmp_path):
+    vectors, index = make_index(tmp_path)
+    hits = index.search(vectors[42], k=5, use_ivf=False)
+    assert hits[0][0] == 42
+    assert hits[0][1] > 0.99
+    assert len(hits) == 5
+
+def test_rescan_keeps_latest(tmp_path):
+    vectors, _ = make_index(tmp_path, count=20)
+    write_results(tmp_path / 'results', vectors[::-1])
+    meta = build_index(str(tmp_path / 'index'), str(tmp_path / 'results'), [7], DIM)
+    assert meta['count'] == 20
+    index = SearchIndex(str(tmp_path / 'index'))
+    assert index.search(vectors[0], k=1, use_ivf=False)[0][0] == 19
+
+def test_ivf_recall(tmp_path):
+    _, index = make_index(tmp_path)
+    index.build_ivf(nlist=8, pq_m=4)
+    report = benchmark(SearchIndex(str(tmp_path / 'index')), queries=20, k=10, nprobe=8)
+    assert report['ivf_recall'] > 0.9
+
+def test_bib_lookup(tmp_path):
+    _, index = make_index(tmp_path, count=30)
+    assert sorted(photo_id for photo_id, _ in index.search_bib('1003')) == [3, 13, 23]
+    assert index.search_bib('42') == []
+
+def test_online_clusters(tmp_path):
+    rng = np.random.default_rng(2)
+    identities = normalize(rng.normal(size=(20, DIM)))
+    faces = normalize(identities[np.arange(400) % 20] + rng.normal(scale=0.1, size=(400, DIM)))
+    write_results(tmp_path / 'results', faces)
+    meta = build_index(str(tmp_path / 'index'), str(tmp_path / 'results'), [7], DIM, cluster_threshold=0.7, cluster_block=64)
+    assert meta['clusters'] == 20
+    index = SearchIndex(str(tmp_path / 'index'))
+    assert index.clusters.rows == 400
+    exact = {photo_id for photo_id, _, _ in index.search(identities[3], k=20, use_clusters=False)}
+    clustered = {photo_id for photo_id, _, _ in index.search(identities[3], k=20, cluster_probe=2)}
+    assert clustered == exact == set(range(3, 400, 20))
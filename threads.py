@@ -0,0 +1,41 @@
+import os
+
+# Every library sizes its own pool to the full core count by default, so N workers on
+# one host would run N x (TensorFlow + Paddle + OpenCV + OpenMP) pools on the same cores.
+
+def thread_budget(processes, threads_config=None):
+    """Threads per process and per library when `processes` model processes share the host."""
+    threads_config = threads_config or {}
+    cores = threads_config.get('cores', 0) or os.cpu_count() or 1
+    per_process = max(cores // max(processes, 1), 1)
+    # Faces (TensorFlow) and OCR (Paddle) run side by side, each gets its share of the process
+    ocr = max(int(round(per_process * threads_config.get('ocr_share', 0.5))), 1)
+    faces = max(per_process - ocr, 1)
+    return {
+        'cores': cores,
+        'process': per_process,
+        'tf_intra': faces,
+        'tf_inter': min(threads_config.get('tf_inter', 1), faces),
+        'ocr': ocr,
+        'cv2': max(threads_config.get('cv2', 1), 1)
+    }
+
+def apply_thread_budget(budget):
+    """Pin the thread pools of the current process, before any model runs.
+
+    The OpenMP/BLAS variables only reach libraries that have not started their pools yet,
+    TensorFlow is set through its API since forkserver workers import it in advance.
+    """
+    for name in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[name] = str(budget['ocr'])
+    os.environ['TF_NUM_INTRAOP_THREADS'] = str(budget['tf_intra'])
+    os.environ['TF_NUM_INTEROP_THREADS'] = str(budget['tf_inter'])
+    import cv2
+    cv2.setNumThreads(budget['cv2'])
+    import tensorflow as tf
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(budget['tf_intra'])
+        tf.config.threading.set_inter_op_parallelism_threads(budget['tf_inter'])
+    except RuntimeError:
+        # TensorFlow was already initialized in this process, its pools keep their size
+        pass